@@ -4,10 +4,12 @@ import argparse
 import logging
 import yaml
 
-from src.ETL.extraction import clone_repositories, process_repositories
-from src.ETL.transformation import extract_entity_for_all_repo, build_set_of_repositories, merge_python_files_by_repository
-from src.ETL.loading import creation_input_output, create_dataset
+from src.ETL.extraction import clone_repositories, iter_repositories_files, DEFAULT_IGNORED_DIRS, DEFAULT_MAX_FILE_SIZE
+from src.ETL.deduplication import NearDuplicateFilter
+from src.ETL.pipeline import PipelineMonitor, build_dataset_pipeline
+from src.utils.cache_utils import DiskCache
 from src.utils.configuration_utils import load_yaml
+from src.utils.dataset_storage import DATASET_SCHEMA, write_dataset, iter_dataset_batches, export_excel_summary
 from src.utils.logger_utils import logger
 
 def main(config_path):
@@ -23,31 +25,71 @@ def main(config_path):
     
     # EXTRACTION
     logger.info("Cloning repositories...")
-    clone_repositories(config["dataset_git"], config['folder_save_dataset'])
+    clone_settings = config.get('clone_settings', {})
+    clone_repositories(config["dataset_git"], config['folder_save_dataset'],
+                       max_workers=clone_settings.get('max_workers', 4),
+                       mode=clone_settings.get('mode', 'full'),
+                       fetch_existing=clone_settings.get('fetch_existing', True))
 
-    # TRANSFORMATION 
-    logger.info("Processing repositories...")
-    all_python_files = process_repositories(config["dataset_git"], config['folder_save_dataset'])
-    processed_files = extract_entity_for_all_repo(all_python_files)
-    set_repository = build_set_of_repositories(processed_files, 3)
-    merged_python_files = merge_python_files_by_repository(processed_files, set_repository)
-
-    # LOADING
-    result = {}
-    for repo in merged_python_files.keys():
-        name_repo = os.path.basename(repo)
-        result[name_repo] = creation_input_output(merged_python_files[repo])
+    # EXTRACTION OF THE SOURCE FILES
+    source_walker = config.get('source_walker', {})
+    source_files = iter_repositories_files(config["dataset_git"], config['folder_save_dataset'],
+                                           extensions=config['programming_language']['python']['extensions'],
+                                           ignored_dirs=source_walker.get('ignored_dirs', DEFAULT_IGNORED_DIRS),
+                                           max_file_size=source_walker.get('max_file_size', DEFAULT_MAX_FILE_SIZE))
+    entity_extraction = config.get('entity_extraction', {})
+    workers, chunk_size = entity_extraction.get('workers', 1), entity_extraction.get('chunk_size', 64)
+    parse_cache_settings = config.get('parse_cache', {})
+    parse_cache = None
+    if parse_cache_settings.get('enabled', False):
+        parse_cache = DiskCache(parse_cache_settings['path'], parse_cache_settings['max_size_mb'] * 1024 * 1024)
 
+    context_settings = config.get('context', {})
+    sample_generation = config.get('sample_generation', {})
     triggers = config['programming_language']['python']['triggers']
-    logger.info("Creating dataset...")
-    dataset = create_dataset(result, triggers, selector_lines="random")
+    token_aware = config['programming_language']['python'].get('token_aware_triggers', False)
+    storage = config.get('dataset_storage', {})
+    deduplication = config.get('deduplication', {})
+    filter_settings = dict(threshold=deduplication.get('threshold', 0.8),
+                           num_perm=deduplication.get('num_perm', 128),
+                           shingle_size=deduplication.get('shingle_size', 5))
+    function_filter = NearDuplicateFilter(**filter_settings) if deduplication.get('functions') else None
+    sample_filter = NearDuplicateFilter(**filter_settings) if deduplication.get('samples') else None
 
-    df = pd.DataFrame(dataset)
+    # TRANSFORMATION AND LOADING, streamed into Parquet shards
+    logger.info("Creating dataset...")
+    monitor = PipelineMonitor(log_every=storage.get('progress_every_seconds', 10))
+    try:
+        samples = build_dataset_pipeline(source_files, triggers, monitor, cache=parse_cache,
+                                         workers=workers, chunk_size=chunk_size,
+                                         max_depth=context_settings.get('max_depth', 1),
+                                         max_tokens=context_settings.get('max_tokens'),
+                                         selector_lines="random", token_aware=token_aware,
+                                         seed=sample_generation.get('seed'),
+                                         sample_workers=sample_generation.get('workers', 1),
+                                         sample_chunk_size=sample_generation.get('chunk_size', 256),
+                                         function_filter=function_filter, sample_filter=sample_filter,
+                                         sample_context_chars=deduplication.get('sample_context_chars', 200))
+        rows_written = write_dataset(samples, config['path_dataset'], schema=DATASET_SCHEMA,
+                                     rows_per_shard=storage.get('rows_per_shard', 100_000),
+                                     row_group_size=storage.get('row_group_size', 10_000),
+                                     compression=storage.get('compression', 'zstd'))
+    finally:
+        if parse_cache is not None:
+            logger.info(f"Parse cache stats: {parse_cache.stats()}")
+            parse_cache.close()
+    monitor.report()
+    if function_filter is not None:
+        function_filter.report('functions')
+    if sample_filter is not None:
+        sample_filter.report('samples')
+    logger.info(f"{rows_written} samples have been saved to {config['path_dataset']}.")
 
-    # SAVE
-    # df.to_csv(config['path_csv_dataset'], index=False, encoding='utf-8')
-    df.to_excel(config['path_xlsx_dataset'], index=False, encoding='utf-8')
-    logger.info(f"Data has been saved to {config['path_csv_dataset']} with UTF-8 encoding.")
+    if storage.get('excel_export_rows'):
+        df = next(iter_dataset_batches(config['path_dataset'], batch_size=storage['excel_export_rows']), None)
+        if df is not None:
+            export_excel_summary(df, config['path_xlsx_dataset'])
+            logger.info(f"The first {len(df)} samples have been exported to {config['path_xlsx_dataset']}.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="ETL Pipeline for Processing Git Repositories")
@@ -1,53 +1,360 @@
+import glob
 import os
+import argparse
 import pandas as pd
+import pyarrow as pa
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 from tqdm import tqdm
 
 
 from src.AI_models.hugging_face_model import ModelHandler
+from src.AI_models.prefix_cache import PrefixKVCache
+from src.AI_models.prompt_builder import FIMPromptBuilder
+from src.AI_models.scheduler import LengthBucketScheduler
+from src.AI_models.stopping import build_stop_conditions
+from src.utils.cache_utils import DiskCache
+from src.utils.checkpoint_log import CheckpointLog
 from src.utils.logger_utils import logger
 from src.utils.configuration_utils import load_yaml
+from src.utils.dataset_storage import (ShardedDatasetWriter, count_rows, excel_to_parquet, export_excel_summary,
+                                       iter_dataset_batches, read_dataset, read_schema)
+from src.utils.token_cache import TokenCache
 
-config=load_yaml('config.yaml')
-df_dataset = pd.read_excel(config['path_dataset_evaluation'])
-model_handler = ModelHandler(config['model_activation'], config['models_configuration']['parameters'])
+# Maximum number of characters of an Excel cell
+EXCEL_CELL_CHARS = 32_767
 
-def generate_text(df_dataset, model_handler, config, output_folder):
-    # Ensure tqdm is used with pandas
-    tqdm.pandas()
 
-    # Use tqdm for progress monitoring
-    for index, row in tqdm(df_dataset.iterrows(), total=df_dataset.shape[0], desc="Generating Text"):
-        try:
-            # Split the prefix and suffix into words
-            prefix_words = row['Prefix'].split()  # Split the prefix text into words
-            suffix_words = row['Suffix'].split()  # Split the suffix text into words
+def parse_shard(value: str) -> Tuple[int, int]:
+    """
+    Parses a `--shard i/N` argument.
+
+    Args:
+        value (str): The shard, as 'index/count' with 0 <= index < count.
+
+    Returns:
+        Tuple[int, int]: The index and the number of shards.
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', expected i/N (e.g. 0/4)")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', expected 0 <= i < N")
+    return index, count
+
+
+def select_rows(total_rows: int, start: int = 0, end: Optional[int] = None,
+                shard: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+    """
+    Computes the rows processed by this run: the requested range, then the contiguous part of it owned by the shard.
+
+    Args:
+        total_rows (int): Number of rows of the dataset.
+        start (int): Position of the first row of the range.
+        end (int, optional): Position after the last row of the range; None means the end of the dataset.
+        shard (Tuple[int, int], optional): The index and the number of shards.
+
+    Returns:
+        Tuple[int, int]: The first row and the row after the last one.
+    """
+    end = total_rows if end is None else min(end, total_rows)
+    start = min(max(start, 0), end)
+    if shard is not None:
+        index, count = shard
+        size = end - start
+        start, end = start + size * index // count, start + size * (index + 1) // count
+    return start, end
+
+
+def results_schema(dataset_path: str, num_sequences: int) -> pa.Schema:
+    """
+    Builds the schema of the results: the sample id, the input columns and one column per generated sequence.
+
+    Args:
+        dataset_path (str): The evaluation dataset.
+        num_sequences (int): Number of sequences generated per sample.
 
-            # Select the last N words from the Prefix and the first N words from the Suffix
-            prefix_last_n_words = prefix_words[-config['padding_input_model']['word_prefix']:]  # Last N words from the Prefix
-            suffix_first_n_words = suffix_words[:config['padding_input_model']['word_suffix']]  # First N words from the Suffix
+    Returns:
+        pa.Schema: The schema of the result rows.
+    """
+    fields = [pa.field('Id', pa.int64())] + list(read_schema(dataset_path))
+    fields += [pa.field(f'Generated{i}', pa.large_string()) for i in range(num_sequences)]
+    return pa.schema(fields)
 
-            # Compose the final string with <fim_prefix>, <fim_suffix>, and <fim_middle>
-            input_text = f"<fim_prefix> {' '.join(prefix_last_n_words)} <fim_suffix> {' '.join(suffix_first_n_words)} <fim_middle>"
 
-            # Generate the text using the model
-            generated_texts = model_handler.generate(input_text)
-            for i in range(len(generated_texts)):
-                df_dataset.at[index, 'Generated'+str(i)] = generated_texts[i]
+def generate_rows(model_handler: ModelHandler, scheduler: LengthBucketScheduler, prompts: Dict[int, List[int]],
+                  errors: Dict[int, str]) -> Dict[int, List[str]]:
+    """
+    Generates the completions of several prompts with batched calls to the model.
+
+    Prompts of similar length are batched together by the scheduler. With a prefix cache, prompts are generated
+    one at a time in dataset order instead, so consecutive samples of the same function reuse each other's
+    prefill. If a batch fails, only its prompts are generated again one by one, so a single bad row neither
+    loses nor regenerates the rest of the chunk.
+
+    Args:
+        model_handler (ModelHandler): The model generating the completions.
+        scheduler (LengthBucketScheduler): Groups the prompts into batches under a token budget.
+        prompts (Dict[int, List[int]]): The token ids of the prompt of each row.
+        errors (Dict[int, str]): Receives the error message of each row that failed.
+
+    Returns:
+        Dict[int, List[str]]: The generated texts of each row that did not fail.
+    """
+    def generate_batch(batch: List[List[int]]) -> list:
+        # The texts of each prompt, or the exception that failed it
+        try:
+            return model_handler.generate_batch(batch)
         except Exception as e:
-            print(f"Error generating text for index {index}: {e}")
+            if len(batch) == 1:
+                return [e]
+            logger.warning(f"Batch generation failed ({e}), generating its {len(batch)} prompts one by one.")
+        results = []
+        for input_ids in batch:
+            try:
+                results.append(model_handler.generate_batch([input_ids])[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    if model_handler.prefix_cache is not None:
+        results = [generate_batch([input_ids])[0] for input_ids in prompts.values()]
+    else:
+        results = scheduler.run(list(prompts.values()), generate_batch)
+
+    generated = {}
+    for position, result in zip(prompts, results):
+        if isinstance(result, Exception):
+            errors[position] = repr(result)
+            logger.error(f"Error generating text for row {position}: {result}")
+        else:
+            generated[position] = result
+    return generated
+
+
+def generate_text(model_handler, config, dataset_path, checkpoint, start, end):
+    """
+    Generates completions for the rows [start, end) of the evaluation dataset that are not completed yet.
+
+    The dataset is read lazily in chunks and the generated texts (or the error) of each row are appended to
+    the checkpoint log as soon as its chunk completes. Rows already completed in the log are skipped, and
+    failed rows are generated again.
+
+    Args:
+        model_handler (ModelHandler): The model generating the completions.
+        config (dict): The configuration.
+        dataset_path (str): The evaluation dataset (Parquet file, folder of shards or Excel file).
+        checkpoint (CheckpointLog): The log receiving the result of each row.
+        start (int): Position of the first row to process.
+        end (int): Position after the last row to process.
+    """
+    prompt_config = config['prompt']
+    prompt_builder = FIMPromptBuilder(model_handler.tokenizer, prompt_config['max_prompt_tokens'],
+                                      prompt_config['suffix_ratio'], **prompt_config['fim_tokens'])
+    truncated = 0
+    processed = 0
+
+    # Token ids of the Prefix and Suffix columns, tokenized once per dataset and tokenizer
+    tokens = None
+    if config['token_cache']['enabled']:
+        # Only the rows of this run are tokenized, so shards of an evaluation do not repeat each other's work
+        tokens = TokenCache(config['token_cache']['path']).load_or_build(dataset_path, model_handler.tokenizer,
+                                                                          start=start, stop=end)
+
+    # The token budget of a batch assumes every row generates its maximum number of tokens
+    new_tokens = model_handler.param_dict.get('max_new_tokens', 0)
+    if model_handler.token_budget is not None:
+        new_tokens = min(new_tokens, model_handler.token_budget)
+    scheduler = LengthBucketScheduler(config['generation']['max_batch_tokens'], config['generation']['batch_size'],
+                                      new_tokens=new_tokens, expand_size=model_handler.expand_size)
+
+    completed = sum(checkpoint.is_completed(position) for position in range(start, end))
+    with tqdm(total=end - start, initial=completed, desc="Generating Text") as progress:
+        for chunk in iter_dataset_batches(dataset_path, columns=['Prefix', 'Suffix'],
+                                          batch_size=config['generation']['chunk_size'], start=start, stop=end):
+            # Rows completed by a previous run are skipped
+            chunk = chunk[[not checkpoint.is_completed(position) for position in chunk.index]]
+            if chunk.empty:
+                continue
+
+            prompts = {}
+            errors = {}
+            for position, prefix, suffix in zip(chunk.index, chunk['Prefix'], chunk['Suffix']):
+                try:
+                    # Keep the end of the Prefix and the start of the Suffix that fit the token budget
+                    encodings = (tokens['Prefix'].encoding(position), tokens['Suffix'].encoding(position)) \
+                        if tokens else ()
+                    prompt = prompt_builder.build(prefix, suffix, *encodings)
+                    truncated += prompt.truncated
+                    prompts[position] = prompt.input_ids
+                except Exception as e:
+                    errors[position] = repr(e)
+                    logger.error(f"Error building the prompt of row {position}: {e}")
+
+            # Generate the texts of the whole chunk, in batches of prompts of similar length
+            generated = generate_rows(model_handler, scheduler, prompts, errors)
+            checkpoint.append({'Id': int(position), 'Generated': generated.get(position),
+                               'Error': errors.get(position)} for position in chunk.index)
+            processed += len(chunk)
+            progress.update(len(chunk))
+
+    if model_handler.prefix_cache is not None:
+        model_handler.prefix_cache.report()
+    else:
+        scheduler.report()
+    if model_handler.speculative_decoder is not None:
+        model_handler.speculative_decoder.report()
+    logger.info(f"Generated {processed} rows, {truncated} prompts were truncated to "
+                f"{prompt_config['max_prompt_tokens']} tokens.")
+
+
+def compact_results(config, dataset_path, checkpoint, output_folder, start, end, num_sequences) -> int:
+    """
+    Writes the final results of the rows [start, end): the sample id, the input columns and the generated texts
+    recorded in the checkpoint log, as Parquet shards named after the row range.
+
+    Args:
+        config (dict): The configuration.
+        dataset_path (str): The evaluation dataset.
+        checkpoint (CheckpointLog): The log holding the result of each row.
+        output_folder (str): The folder receiving the result shards.
+        start (int): Position of the first row.
+        end (int): Position after the last row.
+        num_sequences (int): Number of sequences generated per sample.
+
+    Returns:
+        int: The number of rows without generated texts.
+    """
+    storage = config.get('dataset_storage', {})
+    writer = ShardedDatasetWriter(output_folder, results_schema(dataset_path, num_sequences),
+                                  rows_per_shard=storage.get('rows_per_shard', 100_000),
+                                  row_group_size=storage.get('row_group_size', 10_000),
+                                  compression=storage.get('compression', 'zstd'),
+                                  name=f"rows-{start:09d}-{end:09d}")
+    missing = 0
+    with writer:
+        for chunk in iter_dataset_batches(dataset_path, batch_size=config['generation']['chunk_size'],
+                                          start=start, stop=end):
+            # Missing cells (e.g. empty Excel cells) are written as nulls
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            for position, row in zip(chunk.index, chunk.to_dict('records')):
+                record = checkpoint.read(position)
+                generated_texts = (record or {}).get('Generated') or []
+                missing += not generated_texts
+                result = {'Id': position, **row}
+                result.update({f'Generated{i}': generated_texts[i] if i < len(generated_texts) else None
+                               for i in range(num_sequences)})
+                writer.write(result)
+    return missing
+
+
+def export_review_workbook(output_folder: str, name: str, num_sequences: int) -> Optional[str]:
+    """
+    Exports the results of a row range to an Excel workbook in which a person assigns the taxonomy and the human
+    score of every generated text, to be read by `2_metrics.py` (`input_results_path`).
+
+    The workbook has the sample id, prefix, suffix, label and taxonomy (empty unless the evaluation dataset has
+    one), then every `GeneratedX` column followed by an empty `HumanScoreX` column. Prefix and suffix are cut to
+    the size of an Excel cell, keeping the code nearest to the cursor. A workbook already holding scores is
+    never overwritten.
+
+    Args:
+        output_folder (str): The folder of the result shards.
+        name (str): The name of the result shards of the row range.
+        num_sequences (int): Number of sequences generated per sample.
+
+    Returns:
+        Optional[str]: The path of the workbook, or None if an existing workbook holds scores.
+    """
+    path = os.path.join(output_folder, f"review-{name}.xlsx")
+    score_columns = [f'HumanScore{i}' for i in range(num_sequences)]
+    if os.path.exists(path):
+        scores = pd.read_excel(path, usecols=lambda column: column in score_columns)
+        if scores.notna().any().any():
+            logger.warning(f"{path} already holds human scores, it is not overwritten.")
+            return None
+
+    shards = sorted(glob.glob(os.path.join(output_folder, f"{name}-*.parquet")))
+    df = pd.concat([read_dataset(shard) for shard in shards], ignore_index=True)
+    df['Prefix'] = df['Prefix'].str[-EXCEL_CELL_CHARS:]
+    df['Suffix'] = df['Suffix'].str[:EXCEL_CELL_CHARS]
+    if 'Taxonomy' not in df:
+        df['Taxonomy'] = None
+    for column in score_columns:
+        df[column] = None
+    columns = [column for column in ('Id', 'Prefix', 'Suffix', 'Label', 'Taxonomy') if column in df]
+    columns += [column for i in range(num_sequences) for column in (f'Generated{i}', f'HumanScore{i}')]
+    export_excel_summary(df[columns], path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate completions for the evaluation dataset")
+    parser.add_argument('--config', type=str, default='config.yaml', help='Path to the configuration YAML file.')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='Process only shard i of N (e.g. 0/4) of the selected rows.')
+    parser.add_argument('--start', type=int, default=0, help='Position of the first row to process.')
+    parser.add_argument('--end', type=int, default=None, help='Position after the last row to process.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Folder of the result shards; runs over different rows may share it. '
+                             'Defaults to result/generated_texts_<timestamp>.')
+    parser.add_argument('--no-result-cache', action='store_true',
+                        help='Bypass the cache of generated texts (e.g. to measure the generation time).')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the rows completed by a previous run into --output and retry the failed ones.')
+    args = parser.parse_args()
+    if args.resume and args.output is None:
+        parser.error('--resume requires the --output folder of the run to resume')
+
+    config = load_yaml(args.config)
+    # An Excel dataset is parsed once; every read below memory-maps its Parquet copy
+    dataset_path = excel_to_parquet(config['path_dataset_evaluation'], config['path_converted_datasets'])
+    start, end = select_rows(count_rows(dataset_path), args.start, args.end, args.shard)
+    output_folder = args.output or os.path.join("result", f"generated_texts_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    logger.info(f"Processing rows {start}-{end} of {dataset_path}")
 
-    # Get the current timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    prefix_cache = None
+    if config['prefix_cache']['enabled']:
+        prefix_cache = PrefixKVCache(config['prefix_cache']['max_size_mb'] * 1024 * 1024,
+                                     config['prefix_cache']['min_prefix_tokens'])
+    result_cache = None
+    if config['result_cache']['enabled'] and not args.no_result_cache:
+        result_cache = DiskCache(config['result_cache']['path'], config['result_cache']['max_size_mb'] * 1024 * 1024)
+    stop_conditions = build_stop_conditions(config['stopping']['conditions'],
+                                            config['prompt']['fim_tokens']['fim_prefix'],
+                                            config['prompt']['fim_tokens']['fim_suffix'])
+    model_handler = ModelHandler(config['model_activation'], config['models_configuration']['parameters'],
+                                 batch_size=config['generation']['batch_size'], prefix_cache=prefix_cache,
+                                 result_cache=result_cache, seed=config['generation']['seed'],
+                                 inference=config['inference'], speculative=config['speculative'],
+                                 stop_conditions=stop_conditions, token_budget=config['stopping']['token_budget'])
+    if config['inference']['compare_with_fp32']:
+        model_handler.compare_with_fp32()
 
-    # Ensure the output folder exists
-    os.makedirs(output_folder, exist_ok=True)
+    # Every row is recorded in the checkpoint log as it completes, then the log is compacted into Parquet shards
+    name = f"rows-{start:09d}-{end:09d}"
+    checkpoint_path = os.path.join(output_folder, f"{name}.checkpoint.jsonl")
+    try:
+        with CheckpointLog(checkpoint_path, resume=args.resume) as checkpoint:
+            generate_text(model_handler, config, dataset_path, checkpoint, start, end)
+            missing = compact_results(config, dataset_path, checkpoint, output_folder, start, end,
+                                      model_handler.num_return_sequences)
+    finally:
+        if model_handler.result_cache is not None:
+            logger.info(f"Result cache stats: {result_cache.stats()}")
+        if result_cache is not None:
+            result_cache.close()
 
-    # Save the DataFrame to a CSV file with the timestamp
-    output_file = os.path.join(output_folder, f"generated_texts_{timestamp}.xlsx")
-    df_dataset.to_excel(output_file, index=False)
+    if missing:
+        logger.warning(f"{missing} rows failed; run again with --resume --output {output_folder} to retry them.")
+    else:
+        os.remove(checkpoint_path)
+    logger.info(f"Generated texts of rows {start}-{end} saved to: {output_folder}")
+    review_path = export_review_workbook(output_folder, name, model_handler.num_return_sequences)
+    if review_path is not None:
+        logger.info(f"Assign the taxonomy and the human scores of rows {start}-{end} in: {review_path}")
 
-    print(f"Generated texts saved to: {output_file}")
 
 if __name__ == "__main__":
-    generate_text(df_dataset, model_handler, config, "result")
+    main()
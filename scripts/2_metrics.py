@@ -3,6 +3,7 @@ import nltk
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 from rouge_score import rouge_scorer
 from src.utils.configuration_utils import config
+from src.utils.dataset_storage import read_dataset, read_schema, write_dataset, export_excel_summary
 # Ensure NLTK resources are downloaded
 nltk.download('punkt')
 
@@ -41,8 +42,17 @@ def compute_metrics(reference, generated_text):
 
 
 if __name__ == "__main__":
-    # Load the Excel file into a DataFrame
-    df = pd.read_excel(config['input_excel_path'])
+    # Load only the columns needed for the metrics and the aggregation
+    columns = list(dict.fromkeys([config['label_column'], config['generated_column'], config['taxonomy_column']]
+                                 + [col for col in config['metrics_columns'] if col not in ('BLEU', 'ROUGE-L')]))
+    # Taxonomy and human scores are assigned by hand in the review workbook exported by 1_generate_results.py
+    path = config['input_results_path']
+    available = list(pd.read_excel(path, nrows=0).columns) if path.endswith('.xlsx') else read_schema(path).names
+    missing_columns = [col for col in columns if col not in available]
+    if missing_columns:
+        raise ValueError(f"{path} has no column {missing_columns}: set input_results_path to the review workbook "
+                         f"(review-rows-*.xlsx) of the generated texts once it is scored")
+    df = read_dataset(path, columns=columns)
 
     # Create new columns in the DataFrame to save the metrics
     df['BLEU'] = None
@@ -70,9 +80,9 @@ if __name__ == "__main__":
         count=('Taxonomy', 'size')  # Count occurrences of each taxonomy
     ).reset_index()
 
-    # Save the DataFrames with the prefix 'metrics'
-    df.to_excel(config['output_metrics_path'], index=False)
-    taxonomy_metrics.to_excel(config['output_taxonomy_metrics_path'], index=False)
+    # Save the per-sample metrics as Parquet and the small taxonomy summary as Excel
+    write_dataset(df.to_dict('records'), config['output_metrics_path'])
+    export_excel_summary(taxonomy_metrics, config['output_taxonomy_metrics_path'])
 
     # Display the DataFrames (optional)
     print(df.head())
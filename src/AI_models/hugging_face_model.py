@@ -1,27 +1,118 @@
+import copy
+import sqlite3
 import yaml
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from typing import List, Optional, Sequence
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache, StoppingCriteriaList
+
+from src.AI_models.inference_modes import apply_inference_mode, compare_models, configure_threads
+from src.AI_models.prefix_cache import PrefixKVCache
+from src.AI_models.speculative import SpeculativeDecoder
+from src.AI_models.stopping import CompletionStoppingCriteria, StopCondition, newline_token_ids
+from src.utils.cache_utils import DiskCache, hash_key
+from src.utils.logger_utils import logger
+
+# Bump when the post-processing of generated texts changes, to invalidate the cached results
+GENERATION_CACHE_VERSION = '1'
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    """Returns True if an error was raised because a batch did not fit in (GPU or CPU) memory."""
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
 
 class ModelHandler:
-    def __init__(self, checkpoint: str, param_dict: dict):
+    def __init__(self, checkpoint: str, param_dict: dict, batch_size: int = 1,
+                 prefix_cache: Optional[PrefixKVCache] = None, result_cache: Optional[DiskCache] = None,
+                 seed: Optional[int] = None, inference: Optional[dict] = None, speculative: Optional[dict] = None,
+                 stop_conditions: Sequence[StopCondition] = (), token_budget: Optional[int] = None):
         """
         Initialize the ModelHandler with a model checkpoint and parameters.
 
         :param checkpoint: The model checkpoint to load.
         :param param_dict: Dictionary containing model parameters.
+        :param batch_size: Maximum number of prompts sent to the model at once; it is halved automatically
+            when a batch runs out of memory.
+        :param prefix_cache: If given, the keys and values of prompt prefixes shared with previous prompts are
+            reused instead of being prefilled again; prompts are then generated one at a time.
+        :param result_cache: If given, generated texts are stored and reused for identical prompts, models and
+            generation parameters. It is not used when `do_sample` is set.
+        :param seed: Seed of the random generator of sampling; part of the key of cached results.
+        :param inference: Inference mode: 'precision' ('fp32', 'bf16' or 'int8'), 'compile' (bool),
+            'intra_op_threads' and 'inter_op_threads' (None keeps the PyTorch defaults). Defaults to eager fp32.
+        :param speculative: Assisted decoding: 'draft_checkpoint' (a smaller model sharing the tokenizer; None
+            disables it), 'num_assistant_tokens' and 'baseline_every' (see SpeculativeDecoder). Prompts are then
+            generated one at a time; beam search is not supported.
+        :param stop_conditions: Conditions ending a completion (e.g. at the end of the line); each generated row
+            stops as soon as its completion has ended, and the generated text is cut there.
+        :param token_budget: Maximum number of tokens generated per completion; None leaves it to `max_new_tokens`.
         """
         self.checkpoint = checkpoint
         self.param_dict = param_dict
-        
+        self.batch_size = batch_size
+        self.prefix_cache = prefix_cache
+        self.result_cache = result_cache
+        # Sampled texts depend on the state of the random generator, hence on the composition and order of the
+        # batches, not only on the prompt and the seed: a cache hit would replay texts a fresh run does not draw
+        if result_cache is not None and param_dict.get('do_sample'):
+            logger.warning("The result cache is not used when do_sample is true: sampled texts are not reproducible "
+                           "per prompt.")
+            self.result_cache = None
+        self.seed = seed
+        if seed is not None:
+            torch.manual_seed(seed)
+        self.inference = inference or {}
+        configure_threads(self.inference.get('intra_op_threads'), self.inference.get('inter_op_threads'))
+
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        
+
         # Load the model and tokenizer
         self.model = self.load_model(checkpoint)
         self.tokenizer = self.load_tokenizer(checkpoint)
 
+        # Prompts are padded on the left, so the generated tokens of every row start at the same position
+        self.pad_token_id = param_dict.get('pad_token_id', self.tokenizer.pad_token_id)
+        if self.pad_token_id is None:
+            self.pad_token_id = self.tokenizer.eos_token_id
+        self.generate_kwargs = {**param_dict, 'pad_token_id': self.pad_token_id}
+        self.num_return_sequences = param_dict.get('num_return_sequences', 1)
+        # generate() repeats the prompt once per beam (beam search) or per returned sequence (sampling)
+        self.expand_size = param_dict.get('num_beams', 1) if param_dict.get('num_beams', 1) > 1 \
+            else self.num_return_sequences
+
+        self.stop_conditions = list(stop_conditions)
+        self.token_budget = token_budget
+        self.newline_ids = newline_token_ids(self.tokenizer) if self.stop_conditions else None
+
+        speculative = speculative or {}
+        self.draft_checkpoint = speculative.get('draft_checkpoint')
+        self.speculative_decoder = None
+        if self.draft_checkpoint:
+            self.speculative_decoder = self.load_speculative_decoder(speculative)
+
+        # Everything besides the prompt that determines the generated texts
+        self.model_signature = {
+            'version': GENERATION_CACHE_VERSION,
+            'checkpoint': checkpoint,
+            'revision': getattr(self.model.config, '_commit_hash', None),
+            'parameters': self.generate_kwargs,
+            'seed': seed,
+            'precision': self.precision,
+            'stopping': {'conditions': [[type(condition).__name__, vars(condition)]
+                                        for condition in self.stop_conditions],
+                         'token_budget': token_budget},
+        }
+
     def load_model(self, checkpoint: str):
-        """Load the model from the specified checkpoint."""
+        """Load the model from the specified checkpoint, in the configured precision."""
         model = AutoModelForCausalLM.from_pretrained(checkpoint).to(self.device)
+        model, self.precision = apply_inference_mode(model, self.device, self.inference.get('precision', 'fp32'),
+                                                     self.inference.get('compile', False))
+        logger.info(f"Loaded {checkpoint} in {self.precision}"
+                    f"{' (compiled)' if self.inference.get('compile') else ''} on {self.device}.")
         return model
 
     def load_tokenizer(self, checkpoint: str):
@@ -29,33 +120,216 @@ class ModelHandler:
         tokenizer = AutoTokenizer.from_pretrained(checkpoint)
         return tokenizer
 
-    def generate(self, input_text, skip_special_tokens: bool = False):
-        # Encode the input text
-        input_ids = self.tokenizer.encode(input_text, return_tensors='pt').to(self.device)
-        
-        # Calculate the attention mask for the prefix
-        attention_mask = torch.ones(input_ids.shape, device=self.device)  # Start with all ones
-        if 'pad_token_id' in self.param_dict:
-            attention_mask[input_ids == self.param_dict['pad_token_id']] = 0  # Set padding indices to 0 in the mask
+    def load_speculative_decoder(self, speculative: dict) -> SpeculativeDecoder:
+        """Load the draft model, in the configured precision, and check it can assist the model."""
+        if self.param_dict.get('num_beams', 1) > 1:
+            raise ValueError("Speculative decoding supports greedy search and sampling only, set num_beams to 1")
+        if self.prefix_cache is not None:
+            raise ValueError("Speculative decoding cannot be combined with the prefix cache")
+        if self.load_tokenizer(self.draft_checkpoint).get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(f"The draft model {self.draft_checkpoint} does not share the tokenizer of "
+                             f"{self.checkpoint}")
+
+        draft_model = AutoModelForCausalLM.from_pretrained(self.draft_checkpoint).to(self.device)
+        draft_model, precision = apply_inference_mode(draft_model, self.device, self.inference.get('precision', 'fp32'),
+                                                      self.inference.get('compile', False))
+        logger.info(f"Loaded draft model {self.draft_checkpoint} in {precision} on {self.device}.")
+        return SpeculativeDecoder(self.model, draft_model, speculative.get('num_assistant_tokens', 5),
+                                  speculative.get('baseline_every', 0))
+
+    def compare_with_fp32(self, prompts: Optional[List[str]] = None, max_new_tokens: int = 32) -> dict:
+        """
+        Compare the model, in its configured inference mode, with the fp32 eager model of the same checkpoint.
+
+        :param prompts: The prompts; None uses a fixed set of code prompts.
+        :param max_new_tokens: Number of tokens generated greedily per prompt.
+        :return: The agreement and speed statistics of `compare_models`.
+        """
+        reference = AutoModelForCausalLM.from_pretrained(self.checkpoint).to(self.device).eval()
+        comparison = compare_models(reference, self.model, self.tokenizer, self.device, prompts, max_new_tokens)
+        del reference
+        logger.info(f"{self.precision}{' compiled' if self.inference.get('compile') else ''} vs fp32 on "
+                    f"{comparison['prompts']} prompts: {comparison['exact_match_rate']:.1%} identical generations, "
+                    f"{comparison['token_agreement']:.1%} tokens before the first difference, "
+                    f"{comparison['top1_agreement']:.1%} identical next tokens "
+                    f"(max logit difference {comparison['max_logit_diff']:.3f}); "
+                    f"{comparison['tokens_per_second']:.1f} vs {comparison['reference_tokens_per_second']:.1f} "
+                    f"tokens/s ({comparison['speedup']:.2f}x).")
+        return comparison
+
+    def generate(self, input_text, input_ids: Optional[List[int]] = None):
+        """
+        Generate completions for a prompt.
+
+        :param input_text: The prompt text.
+        :param input_ids: The token ids of the prompt, if already tokenized (e.g. by FIMPromptBuilder);
+            the text is then not encoded again.
+        :return: The list of generated texts.
+        """
+        if input_ids is None:
+            input_ids = self.tokenizer.encode(input_text)
+        return self.generate_batch([input_ids])[0]
+
+    def result_key(self, input_ids: List[int]) -> str:
+        """
+        Build the key of the cached results of a prompt.
+
+        :param input_ids: The token ids of the prompt.
+        :return: A hash of the model, its revision, the generation parameters, the seed and the prompt.
+        """
+        return hash_key(self.model_signature, input_ids)
+
+    def generate_batch(self, prompts: Sequence[List[int]]) -> List[List[str]]:
+        """
+        Generate completions for several tokenized prompts, `batch_size` prompts per call to the model.
+
+        Prompts are left-padded to the longest prompt of their batch with an attention mask excluding the padding.
+        If a batch runs out of memory, the batch size is halved for this and the following calls. With a result
+        cache, only the prompts without cached results are sent to the model; the new results are committed after
+        each call, and a cache that cannot be read or written (e.g. locked by another shard) only costs misses.
+
+        :param prompts: The token ids of each prompt.
+        :return: For each prompt, its `num_return_sequences` generated texts.
+        """
+        if self.result_cache is None:
+            return self._generate_uncached(prompts)
+
+        keys = [self.result_key(input_ids) for input_ids in prompts]
+        results = self._cached_results(keys)
+        missing = [index for index, result in enumerate(results) if result is None]
+        if missing:
+            generated = self._generate_uncached([prompts[index] for index in missing])
+            for index, generated_texts in zip(missing, generated):
+                results[index] = generated_texts
+            self._store_results([(keys[index], results[index]) for index in missing])
+        return results
+
+    def _cached_results(self, keys: List[str]) -> List[Optional[List[str]]]:
+        try:
+            results = [self.result_cache.get(key) for key in keys]
+            # Hits update their access time; the write lock is released before generating
+            self.result_cache.commit()
+            return results
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Result cache unavailable ({e}), generating {len(keys)} prompts.")
+            self.result_cache.rollback()
+            return [None] * len(keys)
+
+    def _store_results(self, items: List[tuple]) -> None:
+        try:
+            for key, generated_texts in items:
+                self.result_cache.set(key, generated_texts)
+            # Committing releases the write lock, so processes sharing the cache are not blocked
+            self.result_cache.commit()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Result cache unavailable ({e}), {len(items)} results not cached.")
+            self.result_cache.rollback()
+
+    def _generate_uncached(self, prompts: Sequence[List[int]]) -> List[List[str]]:
+        if self.prefix_cache is not None:
+            # Cached keys and values belong to a single prompt, so prompts are not padded together
+            return [self._generate_with_prefix_cache(input_ids) for input_ids in prompts]
+        if self.speculative_decoder is not None:
+            return [self._generate_speculative(input_ids) for input_ids in prompts]
+
+        results = []
+        start = 0
+        while start < len(prompts):
+            batch = prompts[start:start + self.batch_size]
+            try:
+                results.extend(self._generate_padded(batch))
+            except Exception as e:
+                if not is_out_of_memory(e) or self.batch_size == 1:
+                    raise
+                self.batch_size //= 2
+                logger.warning(f"Out of memory with {len(batch)} prompts, batch size reduced to {self.batch_size}.")
+                if self.device == 'cuda':
+                    torch.cuda.empty_cache()
+                continue
+            start += len(batch)
+        return results
+
+    def _generate_padded(self, batch: Sequence[List[int]]) -> List[List[str]]:
+        length = max(len(ids) for ids in batch)
+        input_ids = torch.full((len(batch), length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), length), dtype=torch.long)
+        for row, ids in enumerate(batch):
+            input_ids[row, length - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, length - len(ids):] = 1
 
         # Generate outputs using the model with the specified parameters
-        outputs = self.model.generate(input_ids, pad_token_id=self.tokenizer.eos_token_id, attention_mask=attention_mask, **self.param_dict)
-
-        generated_texts = []
-        for output in outputs:
-            generated_text = self.tokenizer.decode(output)
-            
-            # Find the start of <fim_middle> and the first <|endoftext|>
-            fim_middle_idx = generated_text.find('<fim_middle>')
-            endoftext_idx = generated_text.find('<|endoftext|>')
-
-            # Extract the text between <fim_middle> and the first <|endoftext|>
-            if fim_middle_idx != -1 and endoftext_idx != -1:
-                extracted_text = generated_text[fim_middle_idx + len('<fim_middle>'):endoftext_idx].strip()
-                generated_texts.append(extracted_text)
-            else:
-                # If either marker is not found, add the full generated text as fallback
-                generated_texts.append(generated_text)
-
-        # Return the newly generated text
-        return generated_texts
+        stopping = self.stopping_criteria(batch, length)
+        with torch.no_grad():
+            outputs = self.model.generate(input_ids.to(self.device), attention_mask=attention_mask.to(self.device),
+                                          stopping_criteria=stopping, **self.generate_kwargs)
+
+        # The outputs of prompt i are rows [i * n, (i + 1) * n)
+        n = self.num_return_sequences
+        generated_texts = [self.decode_completion(output[length:], stopping, row // n)
+                           for row, output in enumerate(outputs)]
+        return [generated_texts[i * n:(i + 1) * n] for i in range(len(batch))]
+
+    def _generate_with_prefix_cache(self, input_ids: List[int]) -> List[str]:
+        # Every prompt token but the last is prefilled, so generate() still has one token to compute logits from
+        prefill = input_ids[:-1]
+        reused, past_key_values = self.prefix_cache.lookup(prefill)
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        with torch.no_grad():
+            if reused < len(prefill):
+                self.model(torch.tensor([prefill[reused:]], device=self.device), past_key_values=past_key_values,
+                           attention_mask=torch.ones((1, len(prefill)), dtype=torch.long, device=self.device),
+                           use_cache=True)
+            self.prefix_cache.store(prefill, past_key_values)
+
+            # generate() appends to the cache it receives, so it gets a copy of the stored one
+            generation_cache = copy.deepcopy(past_key_values)
+            if self.expand_size > 1:
+                generation_cache.batch_repeat_interleave(self.expand_size)
+            prompt = torch.tensor([input_ids], device=self.device)
+            stopping = self.stopping_criteria([input_ids], len(input_ids))
+            outputs = self.model.generate(prompt, attention_mask=torch.ones_like(prompt),
+                                          past_key_values=generation_cache, stopping_criteria=stopping,
+                                          **self.generate_kwargs)
+        return [self.decode_completion(output[len(input_ids):], stopping) for output in outputs]
+
+    def _generate_speculative(self, input_ids: List[int]) -> List[str]:
+        # Assisted generation verifies the proposals of a single sequence, so sequences are generated one by one
+        prompt = torch.tensor([input_ids], device=self.device)
+        stopping = self.stopping_criteria([input_ids], len(input_ids))
+        generate_kwargs = {**self.generate_kwargs, 'num_return_sequences': 1, 'stopping_criteria': stopping}
+        return [self.decode_completion(self.speculative_decoder.generate(prompt, **generate_kwargs)[0, len(input_ids):],
+                                       stopping)
+                for _ in range(self.num_return_sequences)]
+
+    def stopping_criteria(self, prompts: Sequence[List[int]], prompt_length: int) -> Optional[StoppingCriteriaList]:
+        """
+        Build the stopping criteria of one call to `generate`.
+
+        :param prompts: The token ids of the prompts of the call.
+        :param prompt_length: Position of the first generated token in the rows (the padded prompt length).
+        :return: The criteria, or None without stop conditions and token budget.
+        """
+        if not self.stop_conditions and self.token_budget is None:
+            return None
+        return StoppingCriteriaList([CompletionStoppingCriteria(self.tokenizer, self.stop_conditions, self.newline_ids,
+                                                                prompts, prompt_length, self.token_budget)])
+
+    def decode_completion(self, generated_ids: torch.Tensor, stopping: Optional[StoppingCriteriaList] = None,
+                          prompt_index: int = 0) -> str:
+        """
+        Decode the tokens generated after a prompt, up to the first end-of-sequence token or the end of the
+        completion found by the stop conditions.
+
+        :param generated_ids: The generated token ids, without the prompt.
+        :param stopping: The stopping criteria of the call that generated the tokens.
+        :param prompt_index: The index of the prompt in that call.
+        :return: The generated text.
+        """
+        generated_ids = generated_ids.tolist()
+        if self.tokenizer.eos_token_id in generated_ids:
+            generated_ids = generated_ids[:generated_ids.index(self.tokenizer.eos_token_id)]
+        text = self.tokenizer.decode(generated_ids)
+        if stopping is not None:
+            text = stopping[0].trim(text, prompt_index)
+        return text.strip()
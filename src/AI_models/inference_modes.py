@@ -0,0 +1,141 @@
+import time
+from typing import List, Optional
+
+import torch
+
+from src.utils.logger_utils import logger
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+# Fixed prompts on which an accelerated model is compared with its fp32 version
+COMPARISON_PROMPTS = [
+    "def fibonacci(n):\n    if n < 2:\n        return n\n    return ",
+    "import os\n\n\ndef list_python_files(folder):\n    files = []\n    for root, _, names in os.walk(folder):\n",
+    "class Stack:\n    def __init__(self):\n        self.items = []\n\n    def push(self, item):\n        ",
+    "def read_json(path):\n    with open(path) as f:\n        return ",
+    "for index, value in enumerate(values):\n    if value is None:\n        ",
+    "<fim_prefix>def add(a, b):\n    <fim_suffix>\n\nprint(add(1, 2))<fim_middle>",
+]
+
+
+def configure_threads(intra_op_threads: Optional[int] = None, inter_op_threads: Optional[int] = None) -> None:
+    """
+    Sets the number of threads used by PyTorch operators.
+
+    :param intra_op_threads: Threads used inside an operator (e.g. a matrix multiplication); None keeps the default.
+    :param inter_op_threads: Threads running independent operators concurrently; None keeps the default.
+        It can only be set before PyTorch runs its first parallel operation.
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            logger.warning(f"Inter-op threads can no longer be set ({e}).")
+    logger.info(f"PyTorch threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op.")
+
+
+def bf16_supported(device: str) -> bool:
+    """
+    Returns True if the device runs bfloat16 natively (GPU support, or AVX512-BF16/AMX on CPU).
+
+    :param device: 'cuda' or 'cpu'.
+    """
+    if device == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    checks = (getattr(torch.cpu, '_is_avx512_bf16_supported', None), getattr(torch.cpu, '_is_amx_tile_supported', None))
+    return any(check is not None and check() for check in checks)
+
+
+def apply_inference_mode(model, device: str, precision: str = 'fp32', compile: bool = False):
+    """
+    Converts a loaded fp32 model to the requested precision and optionally compiles it.
+
+    :param model: The model, in fp32 and on `device`.
+    :param device: 'cuda' or 'cpu'.
+    :param precision: 'fp32', 'bf16' (falls back to fp32 if unsupported) or 'int8' (dynamic quantization of the
+        linear layers, CPU only).
+    :param compile: If True, the forward pass is compiled with `torch.compile`, with dynamic shapes since prompt
+        lengths and batch sizes vary.
+    :return: The model and the precision actually applied.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+
+    if precision == 'bf16':
+        if bf16_supported(device):
+            model = model.to(torch.bfloat16)
+        else:
+            logger.warning(f"bfloat16 is not supported natively on this {device}, using fp32.")
+            precision = 'fp32'
+    elif precision == 'int8':
+        if device == 'cpu':
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            logger.warning("Dynamic int8 quantization only runs on CPU, using fp32.")
+            precision = 'fp32'
+
+    if compile:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    model.eval()
+    return model, precision
+
+
+def compare_models(reference, candidate, tokenizer, device: str, prompts: Optional[List[str]] = None,
+                   max_new_tokens: int = 32) -> dict:
+    """
+    Compares a candidate model with a reference model on fixed prompts, with greedy decoding.
+
+    :param reference: The reference (fp32) model.
+    :param candidate: The accelerated model.
+    :param tokenizer: The tokenizer shared by both models.
+    :param device: The device of both models.
+    :param prompts: The prompts; None uses COMPARISON_PROMPTS.
+    :param max_new_tokens: Number of tokens generated per prompt.
+    :return: A dictionary with the share of identical generations, the share of identical generated tokens before
+        the first difference, the agreement of the most likely next token, the largest next-token logit difference,
+        the tokens per second of both models and the speedup.
+    """
+    prompts = prompts or COMPARISON_PROMPTS
+    settings = dict(max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False, num_beams=1,
+                    pad_token_id=tokenizer.eos_token_id)
+    exact, agreement, top1, max_logit_diff = 0, 0.0, 0, 0.0
+    times = {'reference': 0.0, 'candidate': 0.0}
+
+    with torch.no_grad():
+        # Warm-up, so compilation and lazy initialization are not timed
+        warm_up = tokenizer(prompts[0], return_tensors='pt').input_ids.to(device)
+        for model in (reference, candidate):
+            model.generate(warm_up, attention_mask=torch.ones_like(warm_up), **settings)
+
+        for prompt in prompts:
+            input_ids = tokenizer(prompt, return_tensors='pt').input_ids.to(device)
+            reference_logits = reference(input_ids).logits[0, -1].float()
+            candidate_logits = candidate(input_ids).logits[0, -1].float()
+            max_logit_diff = max(max_logit_diff, (reference_logits - candidate_logits).abs().max().item())
+            top1 += reference_logits.argmax().item() == candidate_logits.argmax().item()
+
+            generated = {}
+            for name, model in (('reference', reference), ('candidate', candidate)):
+                start = time.perf_counter()
+                output = model.generate(input_ids, attention_mask=torch.ones_like(input_ids), **settings)
+                times[name] += time.perf_counter() - start
+                generated[name] = output[0, input_ids.shape[1]:].tolist()
+
+            matching = next((index for index, (a, b) in enumerate(zip(generated['reference'], generated['candidate']))
+                             if a != b), len(generated['reference']))
+            exact += matching == len(generated['reference'])
+            agreement += matching / max(len(generated['reference']), 1)
+
+    tokens = max_new_tokens * len(prompts)
+    return {
+        'prompts': len(prompts),
+        'exact_match_rate': exact / len(prompts),
+        'token_agreement': agreement / len(prompts),
+        'top1_agreement': top1 / len(prompts),
+        'max_logit_diff': max_logit_diff,
+        'reference_tokens_per_second': tokens / times['reference'],
+        'tokens_per_second': tokens / times['candidate'],
+        'speedup': times['reference'] / times['candidate'],
+    }
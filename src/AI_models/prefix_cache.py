@@ -0,0 +1,159 @@
+import copy
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from src.utils.logger_utils import logger
+
+
+def cache_nbytes(past_key_values) -> int:
+    """
+    Returns the memory used by the key and value tensors of a `DynamicCache`.
+
+    :param past_key_values: The cache.
+    :return: The size in bytes.
+    """
+    if hasattr(past_key_values, 'layers'):
+        tensors = [tensor for layer in past_key_values.layers for tensor in (layer.keys, layer.values)]
+    else:
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors if tensor is not None)
+
+
+class _Node:
+    __slots__ = ('children', 'entry')
+
+    def __init__(self):
+        self.children = {}
+        # Key of a stored prompt whose tokens pass through this node
+        self.entry = None
+
+
+class PrefixKVCache:
+    """
+    Reuses the attention keys and values (`past_key_values`) of prompts that share leading tokens.
+
+    The token ids of every stored prompt are inserted in a trie; each node points to a stored prompt going
+    through it, so the longest prefix a new prompt shares with any stored prompt is found by walking the trie
+    along its tokens. The keys and values of that prompt, cropped to the shared length, are returned and only
+    the remaining tokens need to be prefilled. Entries are evicted in least recently used order when their
+    total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 1024 * 1024 * 1024, min_prefix_tokens: int = 16):
+        """
+        :param max_bytes: Maximum total size of the stored keys and values.
+        :param min_prefix_tokens: Shorter shared prefixes are not reused, as copying them costs more than
+            prefilling them again.
+        """
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self.root = _Node()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.tokens_saved = 0
+        self.tokens_prefilled = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, input_ids: List[int]) -> Tuple[int, Optional[object]]:
+        """
+        Finds the longest stored prefix of a prompt.
+
+        :param input_ids: The token ids of the prompt to prefill.
+        :return: The number of reused tokens and a copy of their keys and values, or (0, None) on a miss.
+        """
+        self.lookups += 1
+        node, depth = self.root, 0
+        for token in input_ids:
+            child = node.children.get(token)
+            if child is None:
+                break
+            node, depth = child, depth + 1
+
+        if depth < self.min_prefix_tokens or node.entry is None:
+            self.tokens_prefilled += len(input_ids)
+            return 0, None
+
+        key = node.entry
+        self.entries.move_to_end(key)
+        past_key_values = copy.deepcopy(self.entries[key][0])
+        if depth < len(key):
+            past_key_values.crop(depth - len(key))
+        self.hits += 1
+        self.tokens_saved += depth
+        self.tokens_prefilled += len(input_ids) - depth
+        return depth, past_key_values
+
+    def store(self, input_ids: List[int], past_key_values) -> None:
+        """
+        Stores the keys and values of a prompt; the cache keeps a reference, so they must not be modified later.
+
+        :param input_ids: The token ids of the prompt.
+        :param past_key_values: The `DynamicCache` holding exactly the keys and values of `input_ids`.
+        """
+        key = tuple(input_ids)
+        if len(key) < self.min_prefix_tokens:
+            return
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        size = cache_nbytes(past_key_values)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (past_key_values, size)
+        self.total_bytes += size
+        node = self.root
+        for token in key:
+            node = node.children.setdefault(token, _Node())
+            node.entry = key
+
+        while self.total_bytes > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key: tuple) -> None:
+        _, size = self.entries.pop(key)
+        self.total_bytes -= size
+        self.evictions += 1
+
+        path = [self.root]
+        for token in key:
+            path.append(path[-1].children[token])
+        # Bottom-up: nodes pointing to the evicted prompt point to another prompt below them, or are removed
+        for depth in range(len(key), 0, -1):
+            node = path[depth]
+            if node.entry == key:
+                node.entry = next((child.entry for child in node.children.values()), None)
+            if node.entry is None and not node.children:
+                del path[depth - 1].children[key[depth - 1]]
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the cache.
+
+        :return: A dictionary with lookups, hits, hit_rate, tokens_saved, tokens_prefilled, evictions, entries
+            and size in bytes.
+        """
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+            'tokens_saved': self.tokens_saved,
+            'tokens_prefilled': self.tokens_prefilled,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'size_bytes': self.total_bytes,
+        }
+
+    def report(self) -> None:
+        """Logs the statistics of the cache."""
+        stats = self.stats()
+        total = stats['tokens_saved'] + stats['tokens_prefilled']
+        saved = stats['tokens_saved'] / total if total else 0.0
+        logger.info(f"Prefix cache: {stats['hits']}/{stats['lookups']} hits ({stats['hit_rate']:.1%}), "
+                    f"{stats['tokens_saved']} prefill tokens saved ({saved:.1%}), {stats['evictions']} evictions, "
+                    f"{stats['entries']} entries ({stats['size_bytes'] / 2 ** 20:.1f} MB).")
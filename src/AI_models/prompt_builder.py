@@ -0,0 +1,117 @@
+from typing import List, Optional, Tuple
+
+
+class FIMPrompt:
+    """
+    A fill-in-the-middle prompt, kept both as text and as the token ids sent to the model.
+    """
+
+    __slots__ = ('text', 'input_ids', 'prefix_tokens', 'suffix_tokens', 'truncated')
+
+    def __init__(self, text: str, input_ids: List[int], prefix_tokens: int, suffix_tokens: int, truncated: bool):
+        """
+        :param text: The prompt text, with the original whitespace of the kept prefix and suffix.
+        :param input_ids: The token ids of the prompt, special tokens included.
+        :param prefix_tokens: Number of prefix tokens kept.
+        :param suffix_tokens: Number of suffix tokens kept.
+        :param truncated: True if the prefix or the suffix was cut to fit the budget.
+        """
+        self.text = text
+        self.input_ids = input_ids
+        self.prefix_tokens = prefix_tokens
+        self.suffix_tokens = suffix_tokens
+        self.truncated = truncated
+
+    def __len__(self) -> int:
+        return len(self.input_ids)
+
+
+class FIMPromptBuilder:
+    """
+    Builds fill-in-the-middle prompts that fit a token budget.
+
+    The prefix and the suffix are tokenized once each; the prefix keeps its last tokens and the suffix its
+    first tokens, and the text is cut at the character offsets of the kept tokens, so indentation and newlines
+    are preserved exactly. The kept token ids are reused as the model input instead of encoding the prompt again.
+    """
+
+    def __init__(self, tokenizer, max_prompt_tokens: int = 512, suffix_ratio: float = 0.25,
+                 fim_prefix: str = '<fim_prefix>', fim_suffix: str = '<fim_suffix>', fim_middle: str = '<fim_middle>'):
+        """
+        :param tokenizer: A Hugging Face tokenizer; fast tokenizers are required to cut the text at token offsets.
+        :param max_prompt_tokens: Maximum number of tokens of a prompt, special tokens included.
+        :param suffix_ratio: Share of the budget reserved for the suffix; the share left unused by one side
+            is given to the other.
+        :param fim_prefix: The special token opening the prefix.
+        :param fim_suffix: The special token opening the suffix.
+        :param fim_middle: The special token after which the model generates the middle.
+        """
+        self.tokenizer = tokenizer
+        self.markers = (fim_prefix, fim_suffix, fim_middle)
+        self.marker_ids = [self._marker_ids(marker) for marker in self.markers]
+        special_tokens = sum(len(ids) for ids in self.marker_ids)
+        if max_prompt_tokens <= special_tokens:
+            raise ValueError(f"max_prompt_tokens must be larger than the {special_tokens} FIM special tokens")
+        self.budget = max_prompt_tokens - special_tokens
+        self.suffix_ratio = suffix_ratio
+
+    def _marker_ids(self, marker: str) -> List[int]:
+        return self.tokenizer.encode(marker, add_special_tokens=False)
+
+    def _tokenize(self, text: str) -> Tuple[List[int], Optional[List[Tuple[int, int]]]]:
+        if not text:
+            return [], []
+        if getattr(self.tokenizer, 'is_fast', False):
+            encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+            return encoding['input_ids'], encoding['offset_mapping']
+        return self.tokenizer.encode(text, add_special_tokens=False), None
+
+    def allocate(self, prefix_length: int, suffix_length: int) -> Tuple[int, int]:
+        """
+        Splits the token budget between the prefix and the suffix.
+
+        :param prefix_length: Number of tokens of the full prefix.
+        :param suffix_length: Number of tokens of the full suffix.
+        :return: The number of prefix and suffix tokens kept.
+        """
+        suffix_budget = int(self.budget * self.suffix_ratio)
+        suffix_kept = min(suffix_length, suffix_budget)
+        prefix_kept = min(prefix_length, self.budget - suffix_kept)
+        # Budget left unused by a short prefix goes to the suffix
+        suffix_kept = min(suffix_length, self.budget - prefix_kept)
+        return prefix_kept, suffix_kept
+
+    def build(self, prefix: str, suffix: str, prefix_encoding: Optional[Tuple[List[int], Optional[list]]] = None,
+              suffix_encoding: Optional[Tuple[List[int], Optional[list]]] = None) -> FIMPrompt:
+        """
+        Builds the prompt of one sample.
+
+        :param prefix: The code before the cursor.
+        :param suffix: The code after the cursor.
+        :param prefix_encoding: The token ids and character spans of the prefix, if already tokenized
+            (e.g. by TokenCache); None tokenizes the prefix.
+        :param suffix_encoding: The token ids and character spans of the suffix, if already tokenized.
+        :return: The prompt, as text and token ids.
+        """
+        prefix_ids, prefix_offsets = prefix_encoding if prefix_encoding is not None else self._tokenize(prefix)
+        suffix_ids, suffix_offsets = suffix_encoding if suffix_encoding is not None else self._tokenize(suffix)
+        prefix_kept, suffix_kept = self.allocate(len(prefix_ids), len(suffix_ids))
+
+        kept_prefix_ids = prefix_ids[len(prefix_ids) - prefix_kept:]
+        kept_suffix_ids = suffix_ids[:suffix_kept]
+        if prefix_offsets is not None:
+            prefix_text = prefix[prefix_offsets[len(prefix_ids) - prefix_kept][0]:] if prefix_kept else ''
+            suffix_text = suffix[:suffix_offsets[suffix_kept - 1][1]] if suffix_kept else ''
+        else:
+            prefix_text = self.tokenizer.decode(kept_prefix_ids)
+            suffix_text = self.tokenizer.decode(kept_suffix_ids)
+
+        fim_prefix, fim_suffix, fim_middle = self.markers
+        prefix_marker_ids, suffix_marker_ids, middle_marker_ids = self.marker_ids
+        return FIMPrompt(
+            text=f"{fim_prefix}{prefix_text}{fim_suffix}{suffix_text}{fim_middle}",
+            input_ids=prefix_marker_ids + kept_prefix_ids + suffix_marker_ids + kept_suffix_ids + middle_marker_ids,
+            prefix_tokens=prefix_kept,
+            suffix_tokens=suffix_kept,
+            truncated=prefix_kept < len(prefix_ids) or suffix_kept < len(suffix_ids),
+        )
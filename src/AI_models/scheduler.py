@@ -0,0 +1,89 @@
+from typing import Callable, List, Sequence
+
+from src.utils.logger_utils import logger
+
+
+class LengthBucketScheduler:
+    """
+    Groups prompts of similar length into batches that fit a token budget.
+
+    Prompts are sorted by length, longest first, and batches are filled greedily while the padded size of the
+    batch (number of rows times the longest prompt, plus the tokens to generate) stays within
+    `max_batch_tokens`. Every prompt counts for as many rows as `generate` expands it into (beams or returned
+    sequences). Short prompts therefore form large batches and long prompts small ones, and little
+    compute is spent on padding. Results are returned in the original order of the prompts.
+    """
+
+    def __init__(self, max_batch_tokens: int = 4096, max_batch_size: int = 64, new_tokens: int = 0,
+                 expand_size: int = 1):
+        """
+        :param max_batch_tokens: Maximum padded size of a batch, in tokens.
+        :param max_batch_size: Maximum number of prompts of a batch.
+        :param new_tokens: Number of tokens generated per row, added to the length of every row of a batch.
+        :param expand_size: Number of rows of every prompt in the model (e.g. ModelHandler.expand_size).
+        """
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.new_tokens = new_tokens
+        self.expand_size = expand_size
+        self.prompt_tokens = 0
+        self.padded_tokens = 0
+        self.batches = 0
+
+    def plan(self, lengths: Sequence[int]) -> List[List[int]]:
+        """
+        Splits prompts into batches.
+
+        :param lengths: The number of tokens of each prompt.
+        :return: The indexes of the prompts of each batch; a prompt larger than the budget gets its own batch.
+        """
+        order = sorted(range(len(lengths)), key=lambda index: lengths[index], reverse=True)
+        batches = []
+        batch = []
+        for index in order:
+            # The first prompt of a batch is its longest, so it sets the padded length of every row
+            row_tokens = ((lengths[batch[0]] if batch else lengths[index]) + self.new_tokens) * self.expand_size
+            if batch and (len(batch) >= self.max_batch_size or (len(batch) + 1) * row_tokens > self.max_batch_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def run(self, prompts: Sequence[List[int]], generate: Callable[[List[List[int]]], list]) -> list:
+        """
+        Generates the results of prompts batch by batch and restores their original order.
+
+        :param prompts: The token ids of each prompt.
+        :param generate: Returns the results of a batch of prompts, in order (e.g. ModelHandler.generate_batch).
+        :return: The result of each prompt, in the order of `prompts`.
+        """
+        lengths = [len(prompt) for prompt in prompts]
+        results = [None] * len(prompts)
+        for batch in self.plan(lengths):
+            for index, result in zip(batch, generate([prompts[index] for index in batch])):
+                results[index] = result
+            self.prompt_tokens += sum(lengths[index] for index in batch)
+            self.padded_tokens += len(batch) * max(lengths[index] for index in batch)
+            self.batches += 1
+        return results
+
+    def stats(self) -> dict:
+        """
+        Returns the padding statistics of the batches run so far.
+
+        :return: A dictionary with the number of batches, prompt tokens, padded tokens and padding ratio.
+        """
+        return {
+            'batches': self.batches,
+            'prompt_tokens': self.prompt_tokens,
+            'padded_tokens': self.padded_tokens,
+            'padding_ratio': 1 - self.prompt_tokens / self.padded_tokens if self.padded_tokens else 0.0,
+        }
+
+    def report(self) -> None:
+        """Logs the padding statistics."""
+        stats = self.stats()
+        logger.info(f"Scheduled {stats['batches']} batches: {stats['prompt_tokens']} prompt tokens, "
+                    f"{stats['padded_tokens']} with padding ({stats['padding_ratio']:.1%} padding).")
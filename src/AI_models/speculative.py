@@ -0,0 +1,117 @@
+import time
+from typing import Tuple
+
+import torch
+
+from src.utils.logger_utils import logger
+
+
+class SpeculativeDecoder:
+    """
+    Assisted (speculative) decoding: a small draft model proposes the next tokens and the target model verifies
+    them all with a single forward pass, keeping the longest accepted run plus one token of its own.
+
+    Under greedy decoding the output is the one of the target model alone; under sampling the tokens follow the
+    same distribution. Each target forward pass yields `accepted + 1` tokens, so the number of tokens accepted
+    is the number of new tokens minus the number of target forward passes, and the acceptance rate is that
+    number over the tokens proposed (one per forward pass of the draft). Every `baseline_every` prompts, the
+    prompt is also generated without the draft to measure the effective speedup of the run.
+    """
+
+    def __init__(self, model, draft_model, num_assistant_tokens: int = 5, baseline_every: int = 0):
+        """
+        :param model: The target model.
+        :param draft_model: The draft model; it must share the tokenizer of the target model.
+        :param num_assistant_tokens: Number of tokens proposed by the draft before the first verification; it is
+            then adapted to the acceptance of the previous proposals.
+        :param baseline_every: Generate every n-th prompt also without the draft, to measure the speedup;
+            0 disables the measure.
+        """
+        self.model = model
+        self.draft_model = draft_model
+        self.draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        self.baseline_every = baseline_every
+
+        self.generations = 0
+        self.new_tokens = 0
+        self.seconds = 0.0
+        self.forward_passes = {'target': 0, 'draft': 0}
+        self.baseline = {'generations': 0, 'assisted_seconds': 0.0, 'seconds': 0.0, 'mismatches': 0}
+        # Forward passes are only counted during assisted generations
+        self._counting = False
+        model.register_forward_hook(lambda *_: self._count('target'))
+        draft_model.register_forward_hook(lambda *_: self._count('draft'))
+
+    def _count(self, name: str) -> None:
+        if self._counting:
+            self.forward_passes[name] += 1
+
+    def generate(self, input_ids: torch.Tensor, **generate_kwargs) -> torch.Tensor:
+        """
+        Generate one sequence for one prompt.
+
+        :param input_ids: The prompt, with shape (1, length).
+        :param generate_kwargs: The parameters of `generate`; beam search is not supported.
+        :return: The prompt followed by the generated tokens.
+        """
+        outputs, seconds = self._timed_generate(input_ids, assistant_model=self.draft_model, **generate_kwargs)
+        self.generations += 1
+        self.new_tokens += outputs.shape[1] - input_ids.shape[1]
+        self.seconds += seconds
+
+        if self.baseline_every and self.generations % self.baseline_every == 0:
+            baseline, baseline_seconds = self._timed_generate(input_ids, count=False, **generate_kwargs)
+            self.baseline['generations'] += 1
+            self.baseline['assisted_seconds'] += seconds
+            self.baseline['seconds'] += baseline_seconds
+            self.baseline['mismatches'] += not torch.equal(baseline, outputs)
+        return outputs
+
+    def _timed_generate(self, input_ids: torch.Tensor, count: bool = True,
+                        **generate_kwargs) -> Tuple[torch.Tensor, float]:
+        self._counting = count
+        start = time.perf_counter()
+        try:
+            with torch.no_grad():
+                outputs = self.model.generate(input_ids, attention_mask=torch.ones_like(input_ids), **generate_kwargs)
+        finally:
+            self._counting = False
+        return outputs, time.perf_counter() - start
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the assisted generations.
+
+        :return: A dictionary with the number of generations, new tokens, target and draft forward passes, tokens
+            proposed and accepted, acceptance rate, tokens per target forward pass, tokens per second and, when
+            measured, the speedup over generation without the draft and the number of prompts whose sampled
+            baseline output differed (always 0 under greedy decoding).
+        """
+        proposed = self.forward_passes['draft']
+        target_passes = self.forward_passes['target']
+        accepted = max(self.new_tokens - target_passes, 0)
+        baseline = self.baseline
+        return {
+            'generations': self.generations,
+            'new_tokens': self.new_tokens,
+            'target_forward_passes': target_passes,
+            'draft_forward_passes': proposed,
+            'accepted_tokens': accepted,
+            'acceptance_rate': accepted / proposed if proposed else 0.0,
+            'tokens_per_target_pass': self.new_tokens / target_passes if target_passes else 0.0,
+            'tokens_per_second': self.new_tokens / self.seconds if self.seconds else 0.0,
+            'baseline_generations': baseline['generations'],
+            'speedup': baseline['seconds'] / baseline['assisted_seconds'] if baseline['assisted_seconds'] else None,
+            'baseline_mismatches': baseline['mismatches'],
+        }
+
+    def report(self) -> None:
+        """Logs the statistics of the assisted generations."""
+        stats = self.stats()
+        message = (f"Speculative decoding: {stats['accepted_tokens']}/{stats['draft_forward_passes']} draft tokens "
+                   f"accepted ({stats['acceptance_rate']:.1%}), {stats['tokens_per_target_pass']:.2f} tokens per "
+                   f"target forward pass, {stats['tokens_per_second']:.1f} tokens/s")
+        if stats['speedup'] is not None:
+            message += (f", {stats['speedup']:.2f}x speedup over decoding without the draft on "
+                        f"{stats['baseline_generations']} prompts ({stats['baseline_mismatches']} different outputs)")
+        logger.info(message + ".")
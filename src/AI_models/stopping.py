@@ -0,0 +1,178 @@
+import io
+import tokenize
+from typing import List, Optional, Sequence
+
+import torch
+from transformers import StoppingCriteria
+
+STOP_CONDITIONS = ('newline', 'statement_end')
+
+
+def ends_statement(source: str) -> bool:
+    """
+    Returns True if Python source ending with a newline ends a logical line, i.e. the newline is not inside
+    brackets or a triple-quoted string. Only the tokenizer runs, so the check is cheap enough for every newline.
+
+    :param source: The code, from the start of a line.
+    """
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(source).readline):
+            if token.type == tokenize.NEWLINE:
+                return True
+    except tokenize.TokenError as e:
+        # The source ends inside brackets or a string; other errors (e.g. a bracket closing one opened on a
+        # previous line) cannot be resolved from this line, so the newline ends the completion
+        return 'EOF' not in str(e.args[0])
+    except SyntaxError:
+        return True
+    return False
+
+
+class StopCondition:
+    """Decides where a completion ends; every condition ends completions at a newline."""
+
+    def prepare(self, prompt_text: str):
+        """
+        Extracts what the condition needs from a prompt, once per prompt.
+
+        :param prompt_text: The decoded prompt.
+        :return: The context passed to `end` for the completions of this prompt.
+        """
+        return None
+
+    def end(self, text: str, context) -> Optional[int]:
+        """
+        :param text: The text generated so far.
+        :param context: The context returned by `prepare` for the prompt.
+        :return: The length of the completion within `text`, or None if it has not ended yet.
+        """
+        raise NotImplementedError
+
+
+class NewlineStop(StopCondition):
+    """Ends a completion at its first newline, as labels are the remainder of a single line."""
+
+    def end(self, text: str, context) -> Optional[int]:
+        index = text.find('\n')
+        return index if index >= 0 else None
+
+
+class StatementEndStop(StopCondition):
+    """
+    Ends a completion at the first newline that ends the statement of the cursor line, so a call or a literal
+    continued over several lines is completed up to its closing bracket.
+    """
+
+    def __init__(self, fim_prefix: str = '<fim_prefix>', fim_suffix: str = '<fim_suffix>'):
+        """
+        :param fim_prefix: Special token before the prefix in fill-in-the-middle prompts.
+        :param fim_suffix: Special token before the suffix; the cursor line is the last line before it.
+        """
+        self.fim_prefix = fim_prefix
+        self.fim_suffix = fim_suffix
+
+    def prepare(self, prompt_text: str) -> str:
+        prefix = prompt_text.split(self.fim_suffix)[0]
+        line = prefix.rsplit('\n', 1)[-1]
+        return line.split(self.fim_prefix)[-1].lstrip()
+
+    def end(self, text: str, context: str) -> Optional[int]:
+        index = text.find('\n')
+        while index >= 0:
+            if ends_statement(context + text[:index + 1]):
+                return index
+            index = text.find('\n', index + 1)
+        return None
+
+
+def build_stop_conditions(names: Sequence[str], fim_prefix: str = '<fim_prefix>',
+                          fim_suffix: str = '<fim_suffix>') -> List[StopCondition]:
+    """
+    Creates stop conditions from their names.
+
+    :param names: Names among STOP_CONDITIONS.
+    :param fim_prefix: Special token before the prefix in fill-in-the-middle prompts.
+    :param fim_suffix: Special token before the suffix in fill-in-the-middle prompts.
+    :return: The conditions.
+    """
+    conditions = []
+    for name in names:
+        if name == 'newline':
+            conditions.append(NewlineStop())
+        elif name == 'statement_end':
+            conditions.append(StatementEndStop(fim_prefix, fim_suffix))
+        else:
+            raise ValueError(f"Unknown stop condition '{name}', expected one of {STOP_CONDITIONS}")
+    return conditions
+
+
+def newline_token_ids(tokenizer) -> torch.Tensor:
+    """
+    Returns the ids of the tokens whose text contains a newline.
+
+    :param tokenizer: The tokenizer.
+    :return: A 1-D tensor of token ids.
+    """
+    texts = tokenizer.batch_decode([[token_id] for token_id in range(len(tokenizer))])
+    return torch.tensor([token_id for token_id, text in enumerate(texts) if '\n' in text], dtype=torch.long)
+
+
+class CompletionStoppingCriteria(StoppingCriteria):
+    """
+    Stops each generated row as soon as its completion has ended, for the prompts of one call to `generate`.
+
+    The text generated by a row is decoded only once it contains a newline token, since every condition ends
+    completions at a newline; the token budget is checked on the number of new tokens. The rows of a prompt
+    (beams or returned sequences) are consecutive, as `generate` expands every prompt in place.
+    """
+
+    def __init__(self, tokenizer, conditions: Sequence[StopCondition], newline_ids: torch.Tensor,
+                 prompts: Sequence[List[int]], prompt_length: int, token_budget: Optional[int] = None):
+        """
+        :param tokenizer: The tokenizer.
+        :param conditions: The stop conditions; a completion ends at the first end found by any of them.
+        :param newline_ids: The ids of the tokens containing a newline (see newline_token_ids).
+        :param prompts: The token ids of each prompt.
+        :param prompt_length: Position of the first generated token in the rows (the padded prompt length).
+        :param token_budget: Maximum number of generated tokens; None leaves it to `max_new_tokens`.
+        """
+        self.tokenizer = tokenizer
+        self.conditions = conditions
+        self.newline_ids = newline_ids
+        self.prompt_length = prompt_length
+        self.token_budget = token_budget
+        self.contexts = [[condition.prepare(prompt_text) for condition in conditions]
+                         for prompt_text in tokenizer.batch_decode(prompts)] if conditions else []
+        self.num_prompts = len(prompts)
+
+    def end(self, text: str, prompt_index: int) -> Optional[int]:
+        """
+        :param text: The text generated for a prompt.
+        :param prompt_index: The index of the prompt.
+        :return: The length of the completion within `text`, or None if no condition ended it.
+        """
+        ends = [condition.end(text, context)
+                for condition, context in zip(self.conditions, self.contexts[prompt_index])]
+        ends = [end for end in ends if end is not None]
+        return min(ends) if ends else None
+
+    def trim(self, text: str, prompt_index: int) -> str:
+        """Cuts a generated text at the end of its completion."""
+        end = self.end(text, prompt_index) if self.conditions else None
+        return text if end is None else text[:end]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated = input_ids[:, self.prompt_length:]
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if self.token_budget is not None and generated.shape[1] >= self.token_budget:
+            done[:] = True
+            return done
+        if not self.conditions:
+            return done
+
+        rows_per_prompt = input_ids.shape[0] // self.num_prompts
+        has_newline = torch.isin(generated, self.newline_ids.to(input_ids.device)).any(dim=1)
+        for row in has_newline.nonzero().flatten().tolist():
+            text = self.tokenizer.decode(generated[row])
+            done[row] = self.end(text, row // rows_per_prompt) is not None
+        return done
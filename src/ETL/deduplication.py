@@ -0,0 +1,229 @@
+import re
+import zlib
+from collections import Counter
+from itertools import count
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from src.utils.logger_utils import *
+
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+COMMENT_PATTERN = re.compile(r'#[^\n]*')
+
+# Mersenne prime used by the universal hash functions of MinHash; every value fits in 32 bits
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_code(code: str) -> List[str]:
+    """
+    Normalizes code for near-duplicate detection: comments are dropped and layout is ignored.
+
+    Args:
+        code (str): The code to normalize.
+
+    Returns:
+        List[str]: The tokens (words and punctuation symbols) of the code.
+    """
+    return TOKEN_PATTERN.findall(COMMENT_PATTERN.sub('', code))
+
+
+def optimal_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    Chooses the number of LSH bands and rows per band whose similarity threshold, about (1 / bands) ** (1 / rows),
+    is closest to `threshold`.
+
+    The bands cover `bands * rows` permutations, which can be fewer than `num_perm` (e.g. 11 bands of 11 rows for
+    128 permutations); the remaining permutations only take part in the similarity estimate of the candidates.
+
+    Args:
+        num_perm (int): Number of MinHash permutations.
+        threshold (float): Target Jaccard similarity.
+
+    Returns:
+        Tuple[int, int]: The number of bands and the number of rows per band.
+    """
+    candidates = ((bands, num_perm // bands) for bands in range(1, num_perm + 1))
+    return min(candidates, key=lambda band: abs((1 / band[0]) ** (1 / band[1]) - threshold))
+
+
+class MinHasher:
+    """
+    Computes MinHash signatures of token shingles with vectorized universal hash functions.
+    """
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        """
+        Args:
+            num_perm (int): Number of hash functions (length of the signatures).
+            shingle_size (int): Number of consecutive tokens of a shingle.
+            seed (int): Seed of the hash functions, so signatures are stable across runs.
+        """
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, tokens: List[str]) -> np.ndarray:
+        """
+        Hashes the shingles of a list of tokens to 32-bit integers.
+
+        Args:
+            tokens (List[str]): The normalized tokens.
+
+        Returns:
+            np.ndarray: The distinct shingle hashes.
+        """
+        size = min(self.shingle_size, len(tokens))
+        hashes = {zlib.crc32(' '.join(tokens[i:i + size]).encode('utf-8'))
+                  for i in range(len(tokens) - size + 1)}
+        return np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+
+    def signature(self, tokens: List[str]) -> Optional[np.ndarray]:
+        """
+        Computes the MinHash signature of a list of tokens.
+
+        Args:
+            tokens (List[str]): The normalized tokens.
+
+        Returns:
+            Optional[np.ndarray]: The signature, or None if there are no tokens.
+        """
+        if not tokens:
+            return None
+        shingles = self.shingles(tokens) % np.uint64(MERSENNE_PRIME)
+        # a < 2^31 and x < 2^31, so a * x + b fits in 64 bits
+        hashed = (np.outer(self.a, shingles) + self.b[:, None]) % np.uint64(MERSENNE_PRIME)
+        return hashed.min(axis=1).astype(np.uint32)
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate filter backed by a MinHash LSH index.
+
+    The first item of every cluster is kept. The items sharing a band of their signature with a later item are
+    only candidates: the later item is dropped if the Jaccard similarity estimated from the whole signatures
+    (the share of equal MinHash values) reaches `threshold` for one of them, and is kept and indexed otherwise.
+    Each item costs one signature, `bands` dictionary lookups and a comparison with its few candidates, so
+    filtering is linear in the number of items instead of comparing every pair.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        """
+        Args:
+            threshold (float): Jaccard similarity above which two items are considered duplicates.
+            num_perm (int): Number of MinHash permutations.
+            shingle_size (int): Number of consecutive tokens of a shingle.
+            seed (int): Seed of the hash functions.
+        """
+        self.hasher = MinHasher(num_perm, shingle_size, seed)
+        self.threshold = threshold
+        self.bands, self.rows = optimal_bands(num_perm, threshold)
+        # Every band maps its values to the indexes of the kept items having them
+        self.buckets = [{} for _ in range(self.bands)]
+        self.keys = []
+        self.signatures = []
+        self.kept = 0
+        self.removed = Counter()
+        logger.debug(f"LSH index with {self.bands} bands of {self.rows} rows for threshold {threshold}.")
+
+    def check(self, key: str, text: str) -> Optional[str]:
+        """
+        Checks an item against the index and indexes it if it is new.
+
+        Args:
+            key (str): The identifier of the item.
+            text (str): The text of the item.
+
+        Returns:
+            Optional[str]: The key of the item it duplicates, or None if it is kept.
+        """
+        signature = self.hasher.signature(normalize_code(text))
+        if signature is None:
+            self.kept += 1
+            return None
+
+        band_keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+        candidates = list(dict.fromkeys(index for buckets, band_key in zip(self.buckets, band_keys)
+                                        for index in buckets.get(band_key, ())))
+        if candidates:
+            similarities = (np.stack([self.signatures[index] for index in candidates]) == signature).mean(axis=1)
+            best = int(similarities.argmax())
+            if similarities[best] >= self.threshold:
+                representative = self.keys[candidates[best]]
+                self.removed[representative] += 1
+                return representative
+
+        index = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        for buckets, band_key in zip(self.buckets, band_keys):
+            buckets.setdefault(band_key, []).append(index)
+        self.kept += 1
+        return None
+
+    def filter(self, items: Iterable, key: Callable, text: Callable) -> Iterator:
+        """
+        Lazily yields the items that are not near-duplicates of a previous item.
+
+        Args:
+            items (Iterable): The items to filter.
+            key (Callable): Returns the identifier of an item.
+            text (Callable): Returns the text compared for an item.
+
+        Yields:
+            The items kept, in input order.
+        """
+        for item in items:
+            if self.check(key(item), text(item)) is None:
+                yield item
+
+    def report(self, name: str, top: int = 10) -> None:
+        """
+        Logs how many items were removed overall and by the largest clusters.
+
+        Args:
+            name (str): The name of the filtered items (e.g. 'functions').
+            top (int): Number of clusters listed.
+        """
+        total_removed = sum(self.removed.values())
+        logger.info(f"Deduplication of {name}: kept {self.kept}, removed {total_removed} "
+                    f"in {len(self.removed)} clusters.")
+        for representative, removed in self.removed.most_common(top):
+            logger.info(f"  {removed:>8} removed as duplicates of {representative}")
+
+
+def deduplicate_functions(functions: Iterable[tuple], duplicate_filter: NearDuplicateFilter) -> Iterator[tuple]:
+    """
+    Removes near-duplicate functions, comparing their normalized bodies across all repositories.
+
+    Args:
+        functions (Iterable): (repository, function name, source code, ...) tuples.
+        duplicate_filter (NearDuplicateFilter): The filter holding the index of the functions seen so far.
+
+    Yields:
+        tuple: The functions kept.
+    """
+    return duplicate_filter.filter(functions, key=lambda function: f"{function[0]}::{function[1]}",
+                                   text=lambda function: function[2])
+
+
+def deduplicate_samples(samples: Iterable[dict], duplicate_filter: NearDuplicateFilter,
+                        context_chars: int = 200) -> Iterator[dict]:
+    """
+    Removes near-duplicate samples, comparing the code around the cursor.
+
+    Args:
+        samples (Iterable[dict]): Dictionaries containing 'Prefix', 'Suffix', and 'Label'.
+        duplicate_filter (NearDuplicateFilter): The filter holding the index of the samples seen so far.
+        context_chars (int): Number of characters of prefix and suffix compared around the label.
+
+    Yields:
+        dict: The samples kept.
+    """
+    def window(sample: dict) -> str:
+        return sample['Prefix'][-context_chars:] + sample['Label'] + '\n' + sample['Suffix'][:context_chars]
+
+    counter = count()
+    return duplicate_filter.filter(samples, key=lambda sample: f"sample {next(counter)}", text=window)
@@ -1,41 +1,217 @@
 import os
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from src.utils.logger_utils import *
-from typing import Dict, List, Callable
+from typing import Dict, List, Callable, Iterable, Iterator, Optional, Tuple
 
-# Set up the logger
+# Directories never walked when looking for source files
+DEFAULT_IGNORED_DIRS = ('.git', '.hg', '.svn', '__pycache__', '.mypy_cache', '.pytest_cache', '.tox', '.nox',
+                        'venv', '.venv', 'env', 'node_modules', 'site-packages', 'build', 'dist', '.eggs')
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
 
-def clone_repositories(repos: List[str], target_folder: str) -> None:
+# Extra arguments passed to `git clone` for each supported clone mode
+CLONE_MODES = {
+    'full': [],
+    'shallow': ['--depth', '1'],
+    'blobless': ['--filter=blob:none'],
+}
+
+def get_repository_name(repo: str) -> str:
+    """
+    Returns the local folder name of a repository from its URL or path.
+
+    Args:
+        repo (str): Repository URL, `file://` URL or local path.
+
+    Returns:
+        str: The name of the folder the repository is cloned into.
+    """
+    repo_name = repo.rstrip('/').replace('\\', '/').split('/')[-1]
+    if repo_name.endswith('.git'):
+        repo_name = repo_name[:-len('.git')]
+    return repo_name
+
+def clone_or_fetch_repository(repo: str, target_folder: str, mode: str = 'full',
+                              fetch_existing: bool = True) -> Tuple[str, str, float]:
+    """
+    Clones a single repository into the target folder, or fetches it if it is already present.
+
+    Every git command runs with an explicit working directory (`git -C`), so the
+    function does not change the process directory and can be called from several threads.
+
+    Args:
+        repo (str): Repository URL, `file://` URL or local path to clone.
+        target_folder (str): The folder where the repository will be cloned.
+        mode (str): One of the keys of `CLONE_MODES` ('full', 'shallow', 'blobless').
+        fetch_existing (bool): If True, existing repositories are fetched and fast-forwarded, otherwise skipped.
+
+    Returns:
+        Tuple[str, str, float]: The repository name, the action performed ('cloned', 'fetched' or 'skipped')
+        and the elapsed time in seconds.
+    """
+    if mode not in CLONE_MODES:
+        raise ValueError(f"Unknown clone mode '{mode}', expected one of {list(CLONE_MODES)}")
+
+    repo_name = get_repository_name(repo)
+    repo_folder = os.path.join(target_folder, repo_name)
+    start = time.perf_counter()
+
+    if not os.path.exists(repo_folder):
+        logger.info(f"Cloning {repo}...")
+        subprocess.run(['git', 'clone', '--quiet', *CLONE_MODES[mode], repo, repo_folder],
+                       check=True, capture_output=True, text=True)
+        action = 'cloned'
+    elif fetch_existing:
+        logger.info(f"The repository {repo_name} already exists, fetching...")
+        fetch_args = ['--depth', '1'] if mode == 'shallow' else []
+        subprocess.run(['git', '-C', repo_folder, 'fetch', '--quiet', *fetch_args],
+                       check=True, capture_output=True, text=True)
+        # A depth-1 fetch brings a grafted tip unrelated to the local history, so it cannot be merged
+        update = ['reset', '--quiet', '--hard'] if mode == 'shallow' else ['merge', '--quiet', '--ff-only']
+        subprocess.run(['git', '-C', repo_folder, *update, 'FETCH_HEAD'],
+                       check=True, capture_output=True, text=True)
+        action = 'fetched'
+    else:
+        logger.info(f"The repository {repo_name} already exists, skipping...")
+        action = 'skipped'
+
+    return repo_name, action, time.perf_counter() - start
+
+def clone_repositories(repos: List[str], target_folder: str, max_workers: int = 4,
+                       mode: str = 'full', fetch_existing: bool = True) -> Dict[str, Tuple[str, float]]:
     """
-    Clones the repositories into the target folder.
+    Clones the repositories into the target folder using a bounded pool of worker threads.
+
+    Repositories already present are fetched instead of being cloned again. A failure on one
+    repository is logged and does not stop the others. A per-repository timing report is logged at the end.
 
     Args:
         repos (List[str]): List of repository URLs to clone.
         target_folder (str): The folder where the repositories will be cloned.
+        max_workers (int): Maximum number of concurrent git processes.
+        mode (str): Clone mode, one of 'full', 'shallow' or 'blobless'.
+        fetch_existing (bool): If True, repositories already present are fetched, otherwise skipped.
+
+    Returns:
+        Dict[str, Tuple[str, float]]: For each repository name, the action performed
+        ('cloned', 'fetched', 'skipped' or 'failed') and the elapsed time in seconds.
+    """
+    if not os.path.exists(target_folder):
+        os.makedirs(target_folder, exist_ok=True)
+        logger.debug(f"Created target folder: {target_folder}")
+
+    report = {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(clone_or_fetch_repository, repo, target_folder, mode, fetch_existing): repo
+                   for repo in repos}
+        for future in as_completed(futures):
+            repo = futures[future]
+            try:
+                repo_name, action, elapsed = future.result()
+            except subprocess.CalledProcessError as e:
+                repo_name, action, elapsed = get_repository_name(repo), 'failed', 0.0
+                logger.error(f"Error cloning or fetching {repo}: {e.stderr.strip() if e.stderr else e}")
+            except OSError as e:
+                # e.g. git is not installed or the target folder is not writable
+                repo_name, action, elapsed = get_repository_name(repo), 'failed', 0.0
+                logger.error(f"Error cloning or fetching {repo}: {e}")
+            report[repo_name] = (action, elapsed)
+
+    logger.info(f"Repositories synchronized in {time.perf_counter() - start:.2f}s "
+                f"with {max_workers} workers:")
+    for repo_name, (action, elapsed) in sorted(report.items(), key=lambda item: -item[1][1]):
+        logger.info(f"  {repo_name:<40} {action:<8} {elapsed:8.2f}s")
+
+    return report
+
+def read_source_file(file_path: str) -> str:
+    """
+    Reads a source file as UTF-8 text with a single read of its bytes.
+
+    Args:
+        file_path (str): Path of the file to read.
+
+    Returns:
+        str: The content of the file with universal newlines.
+    """
+    with open(file_path, 'rb') as f:
+        content = f.read().decode('utf-8')
+
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
+
+def iter_source_files(repo_folder: str, extensions: Iterable[str] = ('.py',),
+                      ignored_dirs: Iterable[str] = DEFAULT_IGNORED_DIRS,
+                      max_file_size: int = DEFAULT_MAX_FILE_SIZE) -> Iterator[Tuple[str, str]]:
+    """
+    Lazily yields the source files of a repository and their content.
+
+    Ignored directories are pruned from the walk, so they are never listed, and files
+    larger than `max_file_size` are skipped without being read.
+
+    Args:
+        repo_folder (str): The root folder of the repository.
+        extensions (Iterable[str]): File extensions to include (e.g. ['.py']).
+        ignored_dirs (Iterable[str]): Directory names that are not walked (e.g. '.git', 'venv').
+        max_file_size (int): Maximum size in bytes of a file to read; None disables the cutoff.
+
+    Yields:
+        Tuple[str, str]: The file path and its content.
+    """
+    extensions = tuple(extensions)
+    ignored_dirs = set(ignored_dirs)
+
+    for root, dirs, files in os.walk(repo_folder):
+        # Prune in place so os.walk does not descend into ignored folders
+        dirs[:] = [d for d in dirs if d not in ignored_dirs]
+        for file in files:
+            if not file.endswith(extensions):
+                continue
+            file_path = os.path.join(root, file)
+            try:
+                file_size = os.path.getsize(file_path)
+                if max_file_size is not None and file_size > max_file_size:
+                    logger.warning(f"Skipping {file_path}: {file_size} bytes exceeds the limit of {max_file_size}")
+                    continue
+                file_content = read_source_file(file_path)
+            except Exception as e:
+                logger.error(f"Error reading the file {file_path}: {e}")
+                continue
+            logger.debug(f"Read file: {file_path}")
+            yield file_path, file_content
+
+def iter_repositories_files(config_repo: List[str], target_folder: str, extensions: Iterable[str] = ('.py',),
+                            ignored_dirs: Iterable[str] = DEFAULT_IGNORED_DIRS,
+                            max_file_size: int = DEFAULT_MAX_FILE_SIZE) -> Iterator[Tuple[str, str, str]]:
+    """
+    Lazily yields the source files of all the repositories in config_repo.
+
+    Args:
+        config_repo (List[str]): List of repository URLs to process.
+        target_folder (str): The target folder where local repositories are located.
+        extensions (Iterable[str]): File extensions to include.
+        ignored_dirs (Iterable[str]): Directory names that are not walked.
+        max_file_size (int): Maximum size in bytes of a file to read; None disables the cutoff.
+
+    Yields:
+        Tuple[str, str, str]: The repository folder, the file path and its content.
     """
-    # Save the current directory
-    current_dir = os.getcwd()
-
-    try:
-        if not os.path.exists(target_folder):
-            os.makedirs(target_folder)
-            logger.debug(f"Created target folder: {target_folder}")
-        
-        os.chdir(target_folder)
-        logger.debug(f"Changed directory to: {target_folder}")
-        
-        for repo in repos:
-            repo_name = repo.split('/')[-1].replace('.git', '')
-            if not os.path.exists(repo_name):
-                logger.info(f"Cloning {repo}...")
-                subprocess.run(['git', 'clone', repo], check=True)
-            else:
-                logger.info(f"The repository {repo_name} already exists, skipping...")
-    
-    finally:
-        # Return to the original directory
-        os.chdir(current_dir)
-        logger.debug(f"Returned to original directory: {current_dir}")
+    for repo in config_repo:
+        repo_name = get_repository_name(repo)
+        repo_folder = os.path.join(target_folder, repo_name)
+
+        if not os.path.exists(repo_folder):
+            logger.warning(f"Repository folder {repo_folder} not found, skipping...")
+            continue
+
+        logger.info(f"Processing source files in repository: {repo_name}")
+        for file_path, file_content in iter_source_files(repo_folder, extensions, ignored_dirs, max_file_size):
+            yield repo_folder, file_path, file_content
+        logger.info(f"Repository {repo_name} processed.")
 
 def get_python_files_content(repo_folder: str) -> Dict[str, str]:
     """
@@ -47,50 +223,27 @@ def get_python_files_content(repo_folder: str) -> Dict[str, str]:
     Returns:
         Dict[str, str]: A dictionary with file paths as keys and content as values.
     """
-    py_files_content = {}
-    
-    for root, dirs, files in os.walk(repo_folder):
-        for file in files:
-            if file.endswith('.py'):
-                file_path = os.path.join(root, file)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        file_content = f.read()
-                        py_files_content[file_path] = file_content
-                        logger.debug(f"Added file: {file_path}")
-                except Exception as e:
-                    logger.error(f"Error reading the file {file_path}: {e}")
-    
-    return py_files_content
+    return dict(iter_source_files(repo_folder, extensions=('.py',)))
 
 def process_repositories(config_repo: List[str], target_folder: str,
-                         all_python_files: Dict[str, str] = {}) -> None:
+                         all_python_files: Optional[Dict[str, str]] = None) -> Dict[str, str]:
     """
     Processes the specified git repositories in config_repo, extracting and updating the content of Python files from each repository.
 
+    Prefer `iter_repositories_files` for large corpora: this function keeps every file in memory.
+
     Args:
         config_repo (List[str]): List of repository URLs to process.
         target_folder (str): The target folder where local repositories are located.
-        all_python_files (Dict[str, str]): Dictionary containing the contents of all processed Python files.
+        all_python_files (Dict[str, str]): Optional dictionary to update with the contents of the processed Python files.
 
     Returns:
-        None
+        Dict[str, str]: A dictionary with file paths as keys and content as values.
     """
-    for repo in config_repo:
-        # Extract the repository name
-        repo_name = repo.split('/')[-1].replace('.git', '')
-        repo_folder = os.path.join(target_folder, repo_name)
-        
-        # Check if the repository folder exists
-        if os.path.exists(repo_folder):
-            logger.info(f"Processing Python files in repository: {repo_name}")
-            # Get the content of Python files from the repository
-            python_files_content = get_python_files_content(repo_folder)
-            # Update the dictionary with new contents
-            all_python_files.update(python_files_content)
-        else:
-            logger.warning(f"Repository folder {repo_folder} not found, skipping...")
-        
-        logger.info(f"Repository {repo_name} processed.")
+    if all_python_files is None:
+        all_python_files = {}
+
+    for _, file_path, file_content in iter_repositories_files(config_repo, target_folder):
+        all_python_files[file_path] = file_content
 
     return all_python_files
@@ -1,47 +1,107 @@
+import ast
+import io
+import os
 import random
-from typing import List, Dict
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import re
+import textwrap
+import tokenize
+from typing import Callable, Collection, Iterable, Iterator, List, Dict, Optional, Tuple
 
-def extract_used_functions(function_body: str, available_functions: list, current_function: str) -> list:
+from src.ETL.extraction import get_repository_name
+from src.utils.cache_utils import DiskCache, hash_key
+
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+# Bump whenever the output of build_call_graph changes, to invalidate cached graphs
+CALL_GRAPH_VERSION = '1'
+
+
+def extract_identifiers(code: str) -> List[str]:
+    """
+    Extracts the distinct identifiers referenced in a piece of code, in order of first appearance.
+
+    Names come from the `Name` and `Attribute` nodes of the AST (which also cover the callee of every `Call`),
+    so words inside strings and comments are ignored. Code that cannot be parsed falls back to a regex scan
+    of whole identifiers.
+
+    Args:
+        code (str): The source code to scan (e.g. a function or method body, possibly indented).
+
+    Returns:
+        list: The identifiers used in the code.
+    """
+    try:
+        tree = ast.parse(textwrap.dedent(code))
+    except (SyntaxError, ValueError):
+        return list(dict.fromkeys(IDENTIFIER_PATTERN.findall(code)))
+
+    positions = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            positions.append((node.lineno, node.col_offset, node.id))
+        elif isinstance(node, ast.Attribute):
+            positions.append((node.end_lineno, node.end_col_offset, node.attr))
+    positions.sort()
+    return list(dict.fromkeys(name for _, _, name in positions))
+
+
+def extract_used_functions(function_body: str, available_functions: Collection[str], current_function: str,
+                           identifiers: Optional[List[str]] = None) -> list:
     """
     Extracts the functions used in the body of a function, excluding the function itself.
 
     Args:
         function_body (str): The body of the current function.
-        available_functions (list): The list of all available functions.
+        available_functions (Collection[str]): All available function names; pass a set for constant-time lookups.
         current_function (str): The name of the current function.
+        identifiers (list, optional): The identifiers of the body, as returned by `extract_identifiers`.
 
     Returns:
-        list: A list of functions used in the body of the function.
+        list: A list of the functions used in the body of the function.
     """
-    return [func for func in available_functions if func in function_body and func != current_function]
+    if identifiers is None:
+        identifiers = extract_identifiers(function_body)
+    return [name for name in identifiers if name in available_functions and name != current_function]
 
 
-def extract_used_classes(function_body: str, available_classes: list) -> list:
+def extract_used_classes(function_body: str, available_classes: Collection[str],
+                         identifiers: Optional[List[str]] = None) -> list:
     """
     Extracts the classes used in the body of a function.
 
     Args:
         function_body (str): The body of the current function.
-        available_classes (list): The list of all available classes.
+        available_classes (Collection[str]): All available class names; pass a set for constant-time lookups.
+        identifiers (list, optional): The identifiers of the body, as returned by `extract_identifiers`.
 
     Returns:
-        list: A list of classes used in the body of the function.
+        list: A list of the classes used in the body of the function.
     """
-    return [cls for cls in available_classes if cls in function_body]
+    if identifiers is None:
+        identifiers = extract_identifiers(function_body)
+    return [name for name in identifiers if name in available_classes]
 
 
-def extract_class_methods_used(function_body: str, class_methods: dict) -> dict:
+def extract_class_methods_used(function_body: str, class_methods: dict,
+                               identifiers: Optional[List[str]] = None) -> dict:
     """
-    Extracts the class methods that are used in the body of a function.
+    Extracts the methods of a class that are used in the body of a function.
 
     Args:
         function_body (str): The body of the current function.
-        class_methods (dict): A dictionary of class methods.
+        class_methods (dict): A dictionary of the class methods.
+        identifiers (list, optional): The identifiers of the body, as returned by `extract_identifiers`.
 
     Returns:
-        dict: A dictionary with the class methods used in the function.
+        dict: A dictionary of the class methods used in the function.
     """
-    used_methods = {method_name: method_body for method_name, method_body in class_methods.items() if method_name in function_body}
+    if identifiers is None:
+        identifiers = extract_identifiers(function_body)
+    used_methods = {name: class_methods[name] for name in identifiers if name in class_methods}
     return used_methods
 
 
@@ -50,22 +110,21 @@ def format_function_calls(functions: list, repository: dict) -> str:
     Creates a formatted string with the definitions of the used functions.
 
     Args:
-        functions (list): A list of used functions.
+        functions (list): A list of the used functions.
         repository (dict): The repository containing the functions and their definitions.
 
     Returns:
         str: The concatenation of the definitions of the used functions.
     """
-    formatted_functions = ""
-    for func in functions:
-        formatted_functions += repository['functions'][func] + '\n'
-    return formatted_functions
+    return ''.join(repository['functions'][func] + '\n' for func in functions)
 
 
 def format_class_methods(class_name: str, class_info: dict) -> str:
     """
     Creates a formatted string with the definition of a class and its methods.
 
+    The stored __init__ and method sources already include their `def` line and class indentation.
+
     Args:
         class_name (str): The name of the class.
         class_info (dict): The class information, including methods and init.
@@ -73,123 +132,589 @@ def format_class_methods(class_name: str, class_info: dict) -> str:
     Returns:
         str: The definition of the class formatted as a string.
     """
-    formatted_class = f"class {class_name}:\n"
-    formatted_class += f"    {class_info.get('__init__', '')}\n"  # Add the __init__ method if it exists
-    for method_name, method_body in class_info['methods'].items():
-        formatted_class += f"    def {method_name}(self):\n        {method_body}\n"
-    return formatted_class
+    parts = [f"class {class_name}:\n"]
+    if class_info.get('init'):
+        parts.append(class_info['init'] + '\n')
+    for method_body in class_info['methods'].values():
+        parts.append(method_body + '\n')
+    return ''.join(parts)
 
 
-def creation_input_output(repository: dict) -> tuple:
+def approximate_token_count(text: str) -> int:
+    """
+    Approximates the number of model tokens of a text by counting words and punctuation symbols.
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The approximate number of tokens.
+    """
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def build_call_graph(repository: dict) -> dict:
+    """
+    Builds the direct dependencies of every function and class of a repository.
+
+    A function depends on the functions it references and on the classes whose methods it uses;
+    a class depends on everything its __init__ and methods depend on.
+
+    Args:
+        repository (dict): A dictionary containing functions and classes with their methods.
+
+    Returns:
+        dict: {'functions': {name: {'functions': [...], 'classes': [...]}}, 'classes': {name: {...}}}.
+    """
+    all_functions = set(repository['functions'])
+    all_classes = set(repository['classes'])
+
+    def dependencies(code: str, own_name: Optional[str]) -> dict:
+        identifiers = extract_identifiers(code)
+        used_classes = [
+            class_name for class_name in extract_used_classes(code, all_classes, identifiers)
+            if class_name != own_name
+            and extract_class_methods_used(code, repository['classes'][class_name]['methods'], identifiers)
+        ]
+        return {
+            'functions': extract_used_functions(code, all_functions, own_name, identifiers),
+            'classes': used_classes,
+        }
+
+    call_graph = {'functions': {}, 'classes': {}}
+    for func_name, func_body in repository['functions'].items():
+        call_graph['functions'][func_name] = dependencies(func_body, func_name)
+    for class_name, class_info in repository['classes'].items():
+        class_code = '\n'.join([class_info.get('init', '')] + list(class_info['methods'].values()))
+        call_graph['classes'][class_name] = dependencies(class_code, class_name)
+    return call_graph
+
+
+def get_call_graph(repository: dict, cache: Optional[DiskCache] = None) -> dict:
+    """
+    Returns the call graph of a repository, computing it only once.
+
+    The graph is stored in the repository dictionary under 'call_graph' and, when a cache is given,
+    persisted on disk keyed by a hash of the repository functions and classes.
+
+    Args:
+        repository (dict): A dictionary containing functions and classes with their methods.
+        cache (DiskCache, optional): Persistent cache, e.g. the parse cache of the extracted entities.
+
+    Returns:
+        dict: The call graph, as returned by `build_call_graph`.
+    """
+    if 'call_graph' in repository:
+        return repository['call_graph']
+
+    key = hash_key(CALL_GRAPH_VERSION, repository['functions'], repository['classes']) if cache is not None else None
+    call_graph = cache.get(key) if cache is not None else None
+    if call_graph is None:
+        call_graph = build_call_graph(repository)
+        if cache is not None:
+            cache.set(key, call_graph)
+
+    repository['call_graph'] = call_graph
+    return call_graph
+
+
+class ContextBuilder:
+    """
+    Assembles the context of each function from its transitive dependencies in the repository call graph.
+
+    Dependencies are visited breadth-first up to `max_depth` levels (functions before classes at each level)
+    and added while they fit in `max_tokens`. The rendered snippet and token count of every symbol are
+    memoized, so a symbol used by many functions is formatted only once.
+    """
+
+    def __init__(self, repository: dict, call_graph: dict, max_depth: int = 1, max_tokens: Optional[int] = None,
+                 count_tokens: Callable[[str], int] = approximate_token_count):
+        """
+        :param repository: A dictionary containing functions and classes with their methods.
+        :param call_graph: The repository call graph, as returned by `get_call_graph`.
+        :param max_depth: Number of dependency levels to follow (1 keeps only direct dependencies).
+        :param max_tokens: Maximum number of tokens of a context; None disables the budget.
+        :param count_tokens: Function measuring the number of tokens of a snippet.
+        """
+        self.repository = repository
+        self.call_graph = call_graph
+        self.max_depth = max_depth
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.snippets = {}
+
+    def render(self, kind: str, name: str) -> Tuple[str, int]:
+        """
+        Returns the rendered snippet of a symbol and its token count, memoized per symbol.
+
+        :param kind: 'functions' or 'classes'.
+        :param name: The name of the symbol.
+        :return: The snippet and its number of tokens.
+        """
+        snippet = self.snippets.get((kind, name))
+        if snippet is None:
+            if kind == 'functions':
+                text = format_function_calls([name], self.repository)
+            else:
+                text = format_class_methods(name, self.repository['classes'][name])
+            snippet = (text, self.count_tokens(text) if self.max_tokens is not None else 0)
+            self.snippets[(kind, name)] = snippet
+        return snippet
+
+    def build(self, func_name: str) -> str:
+        """
+        Builds the context of a function.
+
+        :param func_name: The name of the function.
+        :return: The concatenated snippets of its dependencies.
+        """
+        visited = {('functions', func_name)}
+        frontier = [('functions', func_name)]
+        parts, used_tokens = [], 0
+
+        for _ in range(self.max_depth):
+            next_level = {'functions': [], 'classes': []}
+            for kind, name in frontier:
+                for dependency_kind in ('functions', 'classes'):
+                    for dependency in self.call_graph[kind][name][dependency_kind]:
+                        if (dependency_kind, dependency) not in visited:
+                            visited.add((dependency_kind, dependency))
+                            next_level[dependency_kind].append((dependency_kind, dependency))
+
+            frontier = next_level['functions'] + next_level['classes']
+            for kind, name in frontier:
+                text, tokens = self.render(kind, name)
+                if self.max_tokens is not None and used_tokens + tokens > self.max_tokens:
+                    continue
+                parts.append(text)
+                used_tokens += tokens
+            if not frontier:
+                break
+
+        return ''.join(parts)
+
+
+def iter_input_output(repository: dict, max_depth: int = 1, max_tokens: Optional[int] = None,
+                      cache: Optional[DiskCache] = None) -> Iterator[Tuple[str, str, str]]:
+    """
+    Lazily yields the context and the body of every function of the repository.
+
+    Args:
+        repository (dict): A dictionary containing functions and classes with their methods.
+        max_depth (int): Number of dependency levels included in each context (1 keeps only direct dependencies).
+        max_tokens (int, optional): Maximum number of tokens of each context; None disables the budget.
+        cache (DiskCache, optional): Persistent cache where the repository call graph is stored.
+
+    Yields:
+        Tuple[str, str, str]: The function name, its formatted context and its body.
+    """
+    call_graph = get_call_graph(repository, cache)
+    context_builder = ContextBuilder(repository, call_graph, max_depth, max_tokens)
+
+    for func_name, func_body in repository['functions'].items():
+        yield func_name, context_builder.build(func_name), func_body
+
+
+def creation_input_output(repository: dict, max_depth: int = 1, max_tokens: Optional[int] = None,
+                          cache: Optional[DiskCache] = None) -> tuple:
     """
     Creates a formatted representation of the functions and classes used in the repository.
 
     Args:
         repository (dict): A dictionary containing functions and classes with their methods.
+        max_depth (int): Number of dependency levels included in each context (1 keeps only direct dependencies).
+        max_tokens (int, optional): Maximum number of tokens of each context; None disables the budget.
+        cache (DiskCache, optional): Persistent cache where the repository call graph is stored.
 
     Returns:
-        tuple: A list of formatted functions and a list of function bodies.
+        tuple: A list of the formatted functions and a list of the function definitions.
     """
     formatted_results, function_bodies = [], []
-    
-    all_functions = list(repository['functions'].keys())
-    all_classes = list(repository['classes'].keys())
-    
-    for func_name, func_body in repository['functions'].items():
-        # Extract the functions used in the current function
-        used_functions = extract_used_functions(func_body, all_functions, func_name)
-        
-        # Extract the classes used in the current function
-        used_classes = extract_used_classes(func_body, all_classes)
-        
-        # Start formatting the code
-        formatted_code = ""
-        
-        # Add the definitions of the used functions
-        formatted_code += format_function_calls(used_functions, repository)
-        
-        # Add the definitions of the classes and their used methods
-        for class_name in used_classes:
-            class_info = repository['classes'][class_name]
-            class_methods_used = extract_class_methods_used(func_body, class_info['methods'])
-            
-            if class_methods_used:
-                formatted_code += format_class_methods(class_name, class_info)
-                
-        # Add the formatted code to the results
+    for _, formatted_code, func_body in iter_input_output(repository, max_depth, max_tokens, cache):
         formatted_results.append(formatted_code)
         function_bodies.append(func_body)
-    
+
     return formatted_results, function_bodies
 
 
-class CodeProcessor:
+class Sample:
+    """
+    Compact view of one sample: the function it comes from, the line and column where the cursor is placed
+    and the trigger that produced it. The Prefix, Suffix and Label strings are not stored.
+    """
+    __slots__ = ('function_id', 'line_index', 'column', 'trigger_id')
+
+    def __init__(self, function_id: int, line_index: int, column: int, trigger_id: int):
+        self.function_id = function_id
+        self.line_index = line_index
+        self.column = column
+        self.trigger_id = trigger_id
+
+    def __repr__(self) -> str:
+        return (f"Sample(function_id={self.function_id}, line_index={self.line_index}, "
+                f"column={self.column}, trigger_id={self.trigger_id})")
+
+
+class SampleSet:
+    """
+    Column-oriented collection of samples backed by arrays of integers.
+
+    Each function source and context is stored once, with the offsets at which its lines start; a sample is four
+    integers. The 'Prefix', 'Suffix' and 'Label' strings are sliced from the function source only when a sample
+    is materialized (e.g. when iterating the set to export it).
+    """
+
     def __init__(self, triggers: List[str]):
+        """
+        :param triggers: List of the triggers referenced by `trigger_id`.
+        """
+        self.triggers = list(triggers)
+        self.codes = []
+        self.contexts = []
+        self.repositories = []
+        self.line_starts = []
+        self.function_ids = array('I')
+        self.line_indexes = array('I')
+        self.columns = array('I')
+        self.trigger_ids = array('H')
+
+    def add_function(self, code: str, repository: str = '', context: str = '') -> int:
+        """
+        Registers the source of a function.
+
+        :param code: The source code of the function.
+        :param repository: The repository the function belongs to.
+        :param context: The definitions of the functions and classes the function depends on.
+        :return: The id of the function.
+        """
+        line_starts = array('I', [0])
+        index = code.find('\n')
+        while index != -1:
+            line_starts.append(index + 1)
+            index = code.find('\n', index + 1)
+        # Sentinel: one past the end of the last line, as if the code ended with a newline
+        line_starts.append(len(code) + 1)
+
+        self.codes.append(code)
+        self.contexts.append(context)
+        self.repositories.append(repository)
+        self.line_starts.append(line_starts)
+        return len(self.codes) - 1
+
+    def add(self, function_id: int, line_index: int, column: int, trigger_id: int) -> None:
+        """
+        Adds a sample.
+
+        :param function_id: The id returned by `add_function`.
+        :param line_index: The index of the line within the function.
+        :param column: The offset in the line right after the trigger, where the label starts.
+        :param trigger_id: The index of the trigger in `triggers`.
+        """
+        self.function_ids.append(function_id)
+        self.line_indexes.append(line_index)
+        self.columns.append(column)
+        self.trigger_ids.append(trigger_id)
+
+    def add_positions(self, function_id: int, positions: Iterable[Tuple[int, int, int]]) -> None:
+        """
+        Adds the samples of a function.
+
+        :param function_id: The id returned by `add_function`.
+        :param positions: An iterable of (line index, column, trigger id).
+        """
+        for line_index, column, trigger_id in positions:
+            self.add(function_id, line_index, column, trigger_id)
+
+    def __len__(self) -> int:
+        return len(self.function_ids)
+
+    def __getitem__(self, index: int) -> Sample:
+        return Sample(self.function_ids[index], self.line_indexes[index], self.columns[index], self.trigger_ids[index])
+
+    def materialize(self, index: int) -> Dict[str, str]:
+        """
+        Builds the strings of a sample.
+
+        :param index: The index of the sample.
+        :return: A dictionary containing 'Prefix', 'Suffix', 'Label' and 'Context'.
+        """
+        function_id, line_index = self.function_ids[index], self.line_indexes[index]
+        code, line_starts = self.codes[function_id], self.line_starts[function_id]
+        cursor = line_starts[line_index] + self.columns[index]
+        line_end = line_starts[line_index + 1] - 1
+
+        return {
+            'Prefix': code[:cursor],
+            'Suffix': code[line_end + 1:],
+            'Label': code[cursor:line_end],
+            'Context': self.contexts[function_id]
+        }
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        for index in range(len(self)):
+            yield self.materialize(index)
+
+
+class TriggerMatcher:
+    """
+    Finds every trigger position of a line with one compiled regular expression.
+
+    Triggers are deduplicated (keeping their first position in the list) and tried longest first, so '=='
+    wins over '=' and matches never overlap. Word triggers such as 'for' or 'is' only match whole
+    identifiers (not 'format' or 'list'). With `token_aware`, positions are taken from the `tokenize`
+    stream instead, so triggers inside strings and comments are ignored as well.
+    """
+
+    def __init__(self, triggers: List[str], token_aware: bool = False):
+        """
+        :param triggers: List of strings representing the triggers.
+        :param token_aware: If True, only NAME and OP tokens equal to a trigger are matched.
+        """
+        self.triggers = list(dict.fromkeys(trigger for trigger in triggers if trigger))
+        self.trigger_ids = {trigger: trigger_id for trigger_id, trigger in enumerate(self.triggers)}
+        self.token_aware = token_aware
+
+        # Whole words are matched first and looked up, so word triggers never match inside identifiers;
+        # the other triggers are tried longest first
+        symbols = sorted((trigger for trigger in self.triggers if not re.fullmatch(r'\w+', trigger)),
+                         key=len, reverse=True)
+        self.pattern = re.compile('|'.join([r'\w+'] + [re.escape(symbol) for symbol in symbols]))
+
+    def find_in_line(self, line: str) -> List[Tuple[int, int]]:
+        """
+        Finds the triggers of a single line.
+
+        :param line: The line to scan.
+        :return: A list of (column right after the trigger, trigger id), from left to right.
+        """
+        trigger_ids = self.trigger_ids
+        return [(match.end(), trigger_ids[match.group()])
+                for match in self.pattern.finditer(line) if match.group() in trigger_ids]
+
+    def find(self, code: str, lines: List[str], num_lines: int) -> Iterator[Tuple[int, int, int]]:
+        """
+        Finds the triggers of the first `num_lines` lines of a code.
+
+        :param code: The code to scan.
+        :param lines: The code split on newlines.
+        :param num_lines: The number of lines to scan.
+        :return: An iterator of (line index, column right after the trigger, trigger id).
+        """
+        if self.token_aware:
+            positions = self.find_tokens(code, num_lines)
+            if positions is not None:
+                return iter(positions)
+
+        return ((i, column, trigger_id)
+                for i in range(num_lines)
+                for column, trigger_id in self.find_in_line(lines[i]))
+
+    def find_tokens(self, code: str, num_lines: int) -> Optional[List[Tuple[int, int, int]]]:
+        """
+        Finds the NAME and OP tokens equal to a trigger, or returns None if the code cannot be tokenized.
+
+        :param code: The code to scan.
+        :param num_lines: The number of lines to scan.
+        :return: A list of (line index, column right after the trigger, trigger id), or None.
+        """
+        positions = []
+        try:
+            for token in tokenize.generate_tokens(io.StringIO(code).readline):
+                if token.start[0] > num_lines:
+                    break
+                if token.type in (tokenize.NAME, tokenize.OP) and token.string in self.trigger_ids:
+                    positions.append((token.start[0] - 1, token.end[1], self.trigger_ids[token.string]))
+        except (tokenize.TokenError, SyntaxError):
+            return None
+        return positions
+
+
+def make_rng(seed: int, *identity: str) -> random.Random:
+    """
+    Creates a random generator that depends only on a global seed and the identity of an item.
+
+    :param seed: The global seed.
+    :param identity: Strings identifying the item (e.g. repository, function name and source code).
+    :return: A `random.Random` instance, independent of the processing order.
+    """
+    return random.Random(int(hash_key(seed, *identity)[:16], 16))
+
+
+class CodeProcessor:
+    def __init__(self, triggers: List[str], token_aware: bool = False, seed: Optional[int] = None):
         """
         Initializes the processor with a list of triggers that separate the code.
         
-        :param triggers: List of strings representing the triggers.
+        :param triggers: List of strings representing the triggers; duplicates are ignored.
+        :param token_aware: If True, triggers inside strings and comments are ignored.
+        :param seed: Global seed; when set, the random line selection of each function only depends on the seed,
+                     the name of its repository, its name and source code. None uses the global `random` state.
         """
-        self.triggers = triggers
+        self.matcher = TriggerMatcher(triggers, token_aware)
+        self.triggers = self.matcher.triggers
+        self.seed = seed
 
-    def process_code(self, code_string: str, suffix: str = '', selector_lines: str = 'random') -> List[Dict[str, str]]:
+    def find_positions(self, code_string: str, repository: str = '', function_name: str = '',
+                       selector_lines: str = 'random') -> List[Tuple[int, int, int]]:
         """
-        Processes source code by identifying the triggers and separating the code into prefixes and suffixes.
+        Finds the trigger positions of a source code.
+
+        Every occurrence of every trigger on a selected line is returned.
 
         :param code_string: The code to process.
-        :param suffix: An optional string to customize the suffix.
+        :param repository: The repository the code belongs to (its folder or URL; only its name is used).
+        :param function_name: The name of the function.
         :param selector_lines: Determines how many lines to process ('random' or specific count).
-        :return: A list of dictionaries containing 'Prefix', 'Suffix', and 'Label'.
+        :return: A list of (line index, column right after the trigger, trigger id).
         """
         # Split the code into lines
         lines = code_string.split('\n')
         
         # Select a random number of lines up to the total number of lines
         if selector_lines == 'random':
-            num_lines_to_process = random.randint(1, len(lines))
+            # Keyed on the repository name, not its folder, so samples do not depend on where it was cloned
+            rng = random if self.seed is None else make_rng(self.seed, get_repository_name(repository),
+                                                             function_name, code_string)
+            num_lines_to_process = rng.randint(1, len(lines))
         else:
             num_lines_to_process = int(len(lines) - 1)
         
-        # List to store processed lines and dictionaries
-        dataset = []
-        
-        for i in range(num_lines_to_process):
-            line = lines[i]
-            for trigger in self.triggers:
-                if trigger in line:
-                    # Separate the part before and after the trigger
-                    prefix, _, line_suffix = line.partition(trigger)
-                    
-                    # Add a dictionary with the relevant parts
-                    dataset.append({
-                        'Prefix': '\n'.join(lines[:i] + [prefix + trigger]),
-                        'Suffix': '\n'.join(lines[i + 1:]),
-                        'Label': line_suffix   # Add the suffix
-                    })
-        
-        return dataset
+        return list(self.matcher.find(code_string, lines, num_lines_to_process))
+
+    def find_samples(self, code_string: str, samples: SampleSet, repository: str = '',
+                     selector_lines: str = 'random', function_name: str = '', context: str = '') -> int:
+        """
+        Finds the trigger positions of a source code and adds them to `samples` as compact records.
 
+        :param code_string: The code to process.
+        :param samples: The set receiving the samples; it must use the processor `triggers`.
+        :param repository: The repository the code belongs to (its folder or URL; only its name is used).
+        :param selector_lines: Determines how many lines to process ('random' or specific count).
+        :param function_name: The name of the function.
+        :param context: The definitions the function depends on, stored with its samples.
+        :return: The number of samples added.
+        """
+        positions = self.find_positions(code_string, repository, function_name, selector_lines)
+        samples.add_positions(samples.add_function(code_string, repository, context), positions)
+        return len(positions)
 
-def create_dataset(result: Dict[str, List[List[str]]], triggers: List[str], selector_lines: str = "random") -> List[Dict[str, str]]:
+    def process_code(self, code_string: str, suffix: str = '', selector_lines: str = 'random') -> List[Dict[str, str]]:
+        """
+        Processes source code by identifying the triggers and separating the code into prefixes and suffixes.
+
+        :param code_string: The code to process.
+        :param suffix: An optional string to customize the suffix.
+        :param selector_lines: Determines how many lines to process ('random' or specific count).
+        :return: A list of dictionaries containing 'Prefix', 'Suffix', and 'Label'.
+        """
+        samples = SampleSet(self.triggers)
+        self.find_samples(code_string, samples, selector_lines=selector_lines)
+        return list(samples)
+
+
+def create_dataset(result: Dict[str, List[List[str]]], triggers: List[str], selector_lines: str = "random",
+                   token_aware: bool = False, seed: Optional[int] = None) -> SampleSet:
     """
     Processes all repositories and the functions contained within them.
 
     :param result: A dictionary with repository data, where each key is a repository,
-                   and the value is a list with two elements:
-                   - A list of function names.
+                   and the value is a list with two elements (as returned by `creation_input_output`):
+                   - A list of function contexts.
                    - A list of source code strings for the functions.
     :param triggers: A list of triggers for separating the code.
     :param selector_lines: Determines how many lines to process ('random' or specific count).
-    :return: A complete dataset of prefixes, suffixes, and labels.
+    :param token_aware: If True, triggers inside strings and comments are ignored.
+    :param seed: Global seed making the random line selection reproducible; None uses the global `random` state.
+    :return: A complete dataset of compact samples; iterating it yields dictionaries of prefixes, suffixes, and labels.
     """
-    processor = CodeProcessor(triggers)
-    dataset = []
+    processor = CodeProcessor(triggers, token_aware, seed)
+    dataset = SampleSet(processor.triggers)
 
-    for repo, (functions, codes) in result.items():
+    for repo, (contexts, codes) in result.items():
         print(f"Processing repository: {repo}")
         
-        for index, code in enumerate(codes):
-            function_name = functions[index]
-            dataset += processor.process_code(code, function_name, selector_lines=selector_lines)
+        for context, code in zip(contexts, codes):
+            processor.find_samples(code, dataset, repo, selector_lines=selector_lines, context=context)
     
     return dataset
+
+
+# Processor of a sample generation worker, created once per process by `init_sample_worker`
+_worker_processor = None
+_worker_selector_lines = 'random'
+
+
+def init_sample_worker(triggers: List[str], token_aware: bool, seed: Optional[int], selector_lines: str) -> None:
+    """
+    Creates the processor of a sample generation worker process.
+
+    :param triggers: A list of triggers for separating the code.
+    :param token_aware: If True, triggers inside strings and comments are ignored.
+    :param seed: Global seed of the random line selection.
+    :param selector_lines: Determines how many lines to process ('random' or specific count).
+    """
+    global _worker_processor, _worker_selector_lines
+    _worker_processor = CodeProcessor(triggers, token_aware, seed)
+    _worker_selector_lines = selector_lines
+
+
+def find_function_positions(function: Tuple[str, str, str]) -> List[Tuple[int, int, int]]:
+    """
+    Finds the trigger positions of one function in a worker process.
+
+    Only the compact positions are sent back; the strings are materialized by the parent process.
+
+    :param function: The repository, name and source code of the function.
+    :return: A list of (line index, column right after the trigger, trigger id).
+    """
+    repo, function_name, code = function
+    return _worker_processor.find_positions(code, repo, function_name, _worker_selector_lines)
+
+
+def iter_dataset(functions: Iterable[Tuple[str, str, str, str]], triggers: List[str], selector_lines: str = "random",
+                 token_aware: bool = False, seed: Optional[int] = None, workers: int = 1,
+                 chunk_size: int = 256) -> Iterator[Dict[str, str]]:
+    """
+    Lazily yields the samples of a stream of functions, optionally on a pool of worker processes.
+
+    Functions are read in windows of `workers * chunk_size * 2` items and their samples are yielded in input
+    order. With a `seed`, the line selection of each function depends only on the seed and the function
+    identity, so the output is identical whatever the number of workers or the way the stream is split.
+
+    :param functions: An iterable of (repository, function name, function source code, context) tuples.
+    :param triggers: A list of triggers for separating the code.
+    :param selector_lines: Determines how many lines to process ('random' or specific count).
+    :param token_aware: If True, triggers inside strings and comments are ignored.
+    :param seed: Global seed of the random line selection; None uses the global `random` state (serial only).
+    :param workers: Number of worker processes; 1 runs serially in the current process, 0 uses every core.
+    :param chunk_size: Number of functions sent to a worker at once.
+    :return: An iterator of dictionaries containing 'Prefix', 'Suffix', 'Label' and 'Context'.
+    """
+    workers = workers or os.cpu_count()
+    if workers > 1 and seed is None:
+        raise ValueError("A seed is required to generate samples on several workers reproducibly")
+
+    processor = CodeProcessor(triggers, token_aware, seed)
+    functions = iter(functions)
+
+    if workers <= 1:
+        for repo, function_name, code, context in functions:
+            samples = SampleSet(processor.triggers)
+            processor.find_samples(code, samples, repo, selector_lines, function_name, context)
+            yield from samples
+        return
+
+    window_size = workers * chunk_size * 2
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_sample_worker,
+                             initargs=(triggers, token_aware, seed, selector_lines)) as executor:
+        while True:
+            window = list(islice(functions, window_size))
+            if not window:
+                break
+            # Contexts stay in this process; workers only need the identity and the source of each function
+            jobs = [function[:3] for function in window]
+            for (repo, _, code, context), positions in zip(window, executor.map(find_function_positions, jobs,
+                                                                                chunksize=chunk_size)):
+                samples = SampleSet(processor.triggers)
+                samples.add_positions(samples.add_function(code, repo, context), positions)
+                yield from samples
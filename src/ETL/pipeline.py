@@ -0,0 +1,215 @@
+import os
+import time
+from itertools import groupby
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from src.ETL.deduplication import NearDuplicateFilter, deduplicate_functions, deduplicate_samples
+from src.ETL.loading import iter_input_output, iter_dataset
+from src.ETL.transformation import iter_extracted_entities, merge_python_files_by_repository
+from src.utils.cache_utils import DiskCache
+from src.utils.logger_utils import *
+
+
+class PipelineMonitor:
+    """
+    Measures the items produced by each stage of a chain of generators.
+
+    Every stage is wrapped with `track`; the time spent in a stage excludes the time spent in the stages
+    it pulls from, so the items per second reported for each stage reflect its own cost.
+    """
+
+    def __init__(self, log_every: float = 10.0):
+        """
+        Args:
+            log_every (float): Minimum number of seconds between two progress logs.
+        """
+        self.log_every = log_every
+        self.stages = []
+        self.counts = {}
+        self.inclusive_times = {}
+        self.upstream = {}
+        self.start = time.perf_counter()
+        self.last_log = self.start
+
+    def track(self, name: str, iterable: Iterable, upstream: Optional[str] = None) -> Iterator:
+        """
+        Wraps a stage so that its items and time are counted.
+
+        Args:
+            name (str): The name of the stage.
+            iterable (Iterable): The items produced by the stage.
+            upstream (str, optional): The name of the tracked stage this one consumes.
+
+        Returns:
+            Iterator: The items of the stage, unchanged.
+        """
+        # Registered now, not on the first item, so stages are reported in pipeline order
+        self.stages.append(name)
+        self.counts[name] = 0
+        self.inclusive_times[name] = 0.0
+        self.upstream[name] = upstream
+        return self._count(name, iter(iterable))
+
+    def _count(self, name: str, iterator: Iterator) -> Iterator:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.inclusive_times[name] += time.perf_counter() - start
+                return
+            now = time.perf_counter()
+            self.inclusive_times[name] += now - start
+            self.counts[name] += 1
+            if now - self.last_log >= self.log_every:
+                self.last_log = now
+                self.log_progress()
+            yield item
+
+    def stage_stats(self, name: str) -> Tuple[int, float, float]:
+        """
+        Returns the statistics of a stage.
+
+        Args:
+            name (str): The name of the stage.
+
+        Returns:
+            Tuple[int, float, float]: The number of items, the time spent in the stage itself and its items per second.
+        """
+        own_time = self.inclusive_times[name]
+        if self.upstream[name] is not None:
+            own_time -= self.inclusive_times[self.upstream[name]]
+        own_time = max(own_time, 0.0)
+        rate = self.counts[name] / own_time if own_time > 0 else 0.0
+        return self.counts[name], own_time, rate
+
+    def log_progress(self) -> None:
+        """Logs the current statistics of every stage."""
+        elapsed = time.perf_counter() - self.start
+        stats = ', '.join(f"{name}: {self.counts[name]}" for name in self.stages)
+        logger.info(f"[{elapsed:.0f}s] {stats}")
+
+    def report(self) -> None:
+        """Logs the final statistics of every stage."""
+        logger.info(f"Pipeline completed in {time.perf_counter() - self.start:.2f}s:")
+        for name in self.stages:
+            count, own_time, rate = self.stage_stats(name)
+            logger.info(f"  {name:<16} {count:>10} items {own_time:10.2f}s {rate:12.1f} items/s")
+
+
+def iter_repositories_entities(entities: Iterable[Tuple[str, str, dict]]) -> Iterator[Tuple[str, dict]]:
+    """
+    Merges the entities of consecutive files of the same repository, one repository at a time.
+
+    Args:
+        entities (Iterable): (repository, file name, record) tuples grouped by repository,
+            as yielded by `iter_extracted_entities` on top of `iter_repositories_files`.
+
+    Yields:
+        Tuple[str, dict]: The repository and its merged entities.
+    """
+    for repository, files in groupby(entities, key=lambda entity: entity[0]):
+        processed_files = {file_name: record for _, file_name, record in files}
+        yield repository, merge_python_files_by_repository(processed_files, {repository})[repository]
+
+
+def iter_repositories_functions(repositories: Iterable[Tuple[str, dict]], max_depth: int = 1,
+                                max_tokens: Optional[int] = None,
+                                cache: Optional[DiskCache] = None) -> Iterator[Tuple[str, str, str, str]]:
+    """
+    Yields the name, body and context (the definitions it depends on) of every function of a stream of merged
+    repositories.
+
+    Args:
+        repositories (Iterable): (repository, merged entities) pairs.
+        max_depth (int): Number of dependency levels included in each context.
+        max_tokens (int, optional): Maximum number of tokens of each context.
+        cache (DiskCache, optional): Persistent cache where the call graphs are stored.
+
+    Yields:
+        Tuple[str, str, str, str]: The repository, the name, the source code and the context of a function.
+    """
+    for repository, merged in repositories:
+        for func_name, context, func_body in iter_input_output(merged, max_depth, max_tokens, cache):
+            yield repository, func_name, func_body, context
+
+
+def split_workers(workers: int, sample_workers: int) -> Tuple[int, int]:
+    """
+    Resolves the number of processes of the two concurrent pools of the pipeline.
+
+    Files are parsed and samples generated at the same time, so a pool set to 0 takes the cores left by the
+    other one instead of every core, and two pools set to 0 share the cores equally.
+
+    Args:
+        workers (int): Number of processes parsing the files; 0 picks it from the available cores.
+        sample_workers (int): Number of processes generating the samples; 0 picks it from the available cores.
+
+    Returns:
+        Tuple[int, int]: The number of processes of both pools, at least 1 each.
+    """
+    cores = os.cpu_count() or 1
+    if not workers and not sample_workers:
+        return max(1, cores // 2), max(1, cores - cores // 2)
+    if not workers:
+        return max(1, cores - sample_workers), sample_workers
+    if not sample_workers:
+        return workers, max(1, cores - workers)
+    return workers, sample_workers
+
+
+def build_dataset_pipeline(source_files: Iterable[Tuple[str, str, str]], triggers: List[str],
+                           monitor: PipelineMonitor, cache: Optional[DiskCache] = None, workers: int = 1,
+                           chunk_size: int = 64, max_depth: int = 1, max_tokens: Optional[int] = None,
+                           selector_lines: str = 'random', token_aware: bool = False, seed: Optional[int] = None,
+                           sample_workers: int = 1, sample_chunk_size: int = 256,
+                           function_filter: Optional[NearDuplicateFilter] = None,
+                           sample_filter: Optional[NearDuplicateFilter] = None,
+                           sample_context_chars: int = 200) -> Iterator[dict]:
+    """
+    Chains extraction, transformation and loading as lazy generators.
+
+    Only one window of files, the entities of one repository and the samples of one function are held
+    in memory at a time; the returned iterator is meant to be consumed by `write_dataset`, which flushes
+    fixed-size shards to disk.
+
+    Args:
+        source_files (Iterable): (repository, file name, content) tuples, as yielded by `iter_repositories_files`.
+        triggers (List[str]): A list of triggers for separating the code.
+        monitor (PipelineMonitor): Monitor receiving the statistics of every stage.
+        cache (DiskCache, optional): Persistent cache of extracted entities and call graphs.
+        workers (int): Number of processes parsing the files; 0 uses the cores left by `sample_workers`.
+        chunk_size (int): Number of files sent to a worker at once.
+        max_depth (int): Number of dependency levels included in each context.
+        max_tokens (int, optional): Maximum number of tokens of each context.
+        selector_lines (str): Determines how many lines to process ('random' or specific count).
+        token_aware (bool): If True, triggers inside strings and comments are ignored.
+        seed (int, optional): Global seed making the random line selection of each function reproducible.
+        sample_workers (int): Number of processes generating the samples; more than 1 requires a seed. 0 uses the
+            cores left by `workers` (see `split_workers`).
+        sample_chunk_size (int): Number of functions sent to a sample worker at once.
+        function_filter (NearDuplicateFilter, optional): Removes near-duplicate functions across repositories.
+        sample_filter (NearDuplicateFilter, optional): Removes near-duplicate samples.
+        sample_context_chars (int): Characters of prefix and suffix compared around the label of a sample.
+
+    Returns:
+        Iterator[dict]: The samples, as dictionaries containing 'Prefix', 'Suffix', 'Label' and 'Context'.
+    """
+    workers, sample_workers = split_workers(workers, sample_workers)
+    logger.info(f"Parsing files with {workers} processes and generating samples with {sample_workers}.")
+    files = monitor.track('files', source_files)
+    entities = monitor.track('entities', iter_extracted_entities(files, cache, workers, chunk_size), 'files')
+    repositories = monitor.track('repositories', iter_repositories_entities(entities), 'entities')
+    functions = monitor.track('functions', iter_repositories_functions(repositories, max_depth, max_tokens, cache),
+                              'repositories')
+    upstream = 'functions'
+    if function_filter is not None:
+        functions = monitor.track('unique_functions', deduplicate_functions(functions, function_filter), upstream)
+        upstream = 'unique_functions'
+
+    samples = iter_dataset(functions, triggers, selector_lines, token_aware, seed, sample_workers, sample_chunk_size)
+    samples = monitor.track('samples', samples, upstream)
+    if sample_filter is not None:
+        samples = monitor.track('unique_samples', deduplicate_samples(samples, sample_filter, sample_context_chars),
+                                'samples')
+    return samples
@@ -2,115 +2,136 @@ import ast
 import json
 import argparse
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterator, Optional, Tuple
+from src.utils.cache_utils import DiskCache, hash_key
 from src.utils.logger_utils import *
 
-class ClassExtractor(ast.NodeVisitor):
+# Bump whenever the output of extract_lib_func_class_global changes, to invalidate cached records
+EXTRACTOR_VERSION = '2'
+
+class EntityExtractor(ast.NodeVisitor):
     """
-    Class to extract class names, methods (including __init__), and their source code from Python code.
+    Single-pass visitor that extracts imports, functions, classes (with __init__ and methods) and global code.
+
+    The tree is traversed once. Source code is sliced from the encoded file content with the
+    `end_lineno`/`end_col_offset` positions of each node, using one shared table of line offsets,
+    so multi-line final statements are kept whole.
 
     Args:
         file_content (str): The content of the Python file to analyze.
-    
+
     Attributes:
-        classes (dict): Dictionary that stores information about classes, with 'init' and 'methods'.
-        file_content (str): The content of the provided file.
-        lines (list): List of lines from the file, useful for extracting source code.
+        imports (list): Source of every `import`/`from ... import` statement, in file order.
+        functions (dict): Functions and methods (sync and async) that are not nested in another function, with their code.
+        classes (dict): Classes that are not nested in a function, with 'init' and 'methods'.
+        global_code (list): Source of the module-level statements that are not imports, functions or classes.
     """
+    FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef)
+
     def __init__(self, file_content: str):
+        self.imports = []
+        self.functions = {}
         self.classes = {}
-        self.file_content = file_content
-        self.lines = file_content.splitlines()
-        logger.debug("ClassExtractor initialized.")
-
-    def visit_ClassDef(self, node: ast.ClassDef) -> None:
+        self.global_code = []
+        self.source = file_content.encode('utf-8')
+        self.line_offsets = self.build_line_offsets(self.source)
+        self.function_depth = 0
+        logger.debug("EntityExtractor initialized.")
+
+    @staticmethod
+    def build_line_offsets(source: bytes) -> list:
         """
-        Visits the class definition and extracts its methods and the __init__ constructor.
+        Builds the table of byte offsets at which each line starts.
 
         Args:
-            node (ast.ClassDef): AST node representing a class definition.
+            source (bytes): The encoded file content.
+
+        Returns:
+            list: `offsets[i]` is the byte offset of line i + 1.
         """
-        class_name = node.name
-        class_info = {'init': '', 'methods': {}}
-        logger.debug(f"Found class: {class_name}")
-        
-        for class_body_item in node.body:
-            if isinstance(class_body_item, ast.FunctionDef):
-                method_name = class_body_item.name
-                method_code = self.get_function_code(class_body_item)
-                logger.debug(f"Extracted method: {method_name} from class: {class_name}")
-                
-                if method_name == '__init__':
-                    class_info['init'] = method_code
-                else:
-                    class_info['methods'][method_name] = method_code
-        
-        self.classes[class_name] = class_info
-        logger.info(f"Class {class_name} processed with methods: {list(class_info['methods'].keys())}")
-
-    def get_function_code(self, node: ast.FunctionDef) -> str:
+        offsets = [0]
+        index = source.find(b'\n')
+        while index != -1:
+            offsets.append(index + 1)
+            index = source.find(b'\n', index + 1)
+        return offsets
+
+    def get_source(self, node: ast.AST, from_line_start: bool = True) -> str:
         """
-        Extracts the source code of the function.
+        Extracts the source code of a node.
 
         Args:
-            node (ast.FunctionDef): AST node representing a function or method.
+            node (ast.AST): The node to extract.
+            from_line_start (bool): If True, the code starts at the beginning of the first line, keeping its indentation.
 
         Returns:
-            str: The source code of the function or method.
+            str: The source code of the node.
         """
-        start_line = node.lineno - 1
-        end_line = node.body[-1].lineno
-        logger.debug(f"Extracting function code from lines {start_line + 1} to {end_line}")
-        return "\n".join(self.lines[start_line:end_line])
+        start = self.line_offsets[node.lineno - 1]
+        if not from_line_start:
+            start += node.col_offset
+        end = self.line_offsets[node.end_lineno - 1] + node.end_col_offset
+        return self.source[start:end].decode('utf-8')
 
-class FunctionExtractor(ast.NodeVisitor):
-    """
-    Class to extract function names and their complete source code from Python code.
+    def visit_Module(self, node: ast.Module) -> None:
+        for statement in node.body:
+            if not isinstance(statement, (ast.Import, ast.ImportFrom, ast.ClassDef) + self.FUNCTION_NODES):
+                self.global_code.append(self.get_source(statement, from_line_start=False))
+            self.visit(statement)
 
-    Args:
-        file_content (str): The content of the Python file to analyze.
-    
-    Attributes:
-        functions (dict): Dictionary that stores functions and their code.
-        file_content (str): The content of the provided file.
-        lines (list): List of lines from the file, useful for extracting source code.
-    """
-    def __init__(self, file_content: str):
-        self.functions = {}
-        self.file_content = file_content
-        self.lines = file_content.splitlines()
-        logger.debug("FunctionExtractor initialized.")
+    def visit_Import(self, node: ast.Import) -> None:
+        self.imports.append(self.get_source(node, from_line_start=False))
+
+    visit_ImportFrom = visit_Import
 
     def visit_FunctionDef(self, node: ast.FunctionDef) -> None:
         """
-        Visits the function definition and extracts its name and source code.
+        Visits a function or method definition and stores its source code unless it is nested in another function.
 
         Args:
-            node (ast.FunctionDef): AST node representing a function.
+            node (ast.FunctionDef): AST node representing a function (sync or async).
         """
-        function_name = node.name
-        function_code = self.get_function_code(node)
-        self.functions[function_name] = function_code
-        logger.info(f"Extracted function: {function_name}")
+        if self.function_depth == 0:
+            self.functions[node.name] = self.get_source(node)
+            logger.debug(f"Extracted function: {node.name}")
 
-    def get_function_code(self, node: ast.FunctionDef) -> str:
+        # Keep walking the body to collect the imports it contains
+        self.function_depth += 1
+        self.generic_visit(node)
+        self.function_depth -= 1
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node: ast.ClassDef) -> None:
         """
-        Extracts the source code of the function.
+        Visits the class definition and extracts its methods and the __init__ constructor.
 
         Args:
-            node (ast.FunctionDef): AST node representing a function.
-
-        Returns:
-            str: The source code of the function.
+            node (ast.ClassDef): AST node representing a class definition.
         """
-        start_line = node.lineno - 1
-        end_line = node.body[-1].lineno
-        logger.debug(f"Extracting function code from lines {start_line + 1} to {end_line}")
-        return "\n".join(self.lines[start_line:end_line])
+        if self.function_depth == 0:
+            class_info = {'init': '', 'methods': {}}
+            for class_body_item in node.body:
+                if isinstance(class_body_item, self.FUNCTION_NODES):
+                    method_code = self.get_source(class_body_item)
+                    if class_body_item.name == '__init__':
+                        class_info['init'] = method_code
+                    else:
+                        class_info['methods'][class_body_item.name] = method_code
+            self.classes[node.name] = class_info
+            logger.debug(f"Class {node.name} processed with methods: {list(class_info['methods'].keys())}")
+
+        self.generic_visit(node)
 
 def extract_lib_func_class_global(file_content: str) -> dict:
     """
     Preprocesses the content of a Python file to extract libraries, functions, classes (with __init__ and methods), and global code.
 
+    Files that cannot be parsed fall back to a line scan: import lines go to 'library' and every other line to 'global'.
+
     Args:
         file_content (str): The content of a Python file as a string.
 
@@ -123,61 +144,134 @@ def extract_lib_func_class_global(file_content: str) -> dict:
         'classes': {},
         'global': ''
     }
-    
-    lines = file_content.splitlines()
-    imported_libraries = []
-    global_code = []
-    
-    logger.debug("Starting to extract libraries and global code.")
-    
-    for line in lines:
-        stripped_line = line.strip()
-        if stripped_line.startswith('import') or stripped_line.startswith('from'):
-            imported_libraries.append(stripped_line)
-        else:
-            global_code.append(stripped_line)
-    
-    result['library'] = '\n'.join(imported_libraries)
-    logger.debug(f"Extracted libraries: {result['library']}")
-    
+
     try:
         tree = ast.parse(file_content)
-        logger.debug("AST parsing successful.")
-        
-        function_extractor = FunctionExtractor(file_content)
-        function_extractor.visit(tree)
-        result['functions'] = function_extractor.functions
-        
-        class_extractor = ClassExtractor(file_content)
-        class_extractor.visit(tree)
-        result['classes'] = class_extractor.classes
-
-    except Exception as e:
+    except (SyntaxError, ValueError) as e:
         logger.error(f"Error parsing Python code: {e}")
-    
-    global_code_str = '\n'.join(line for line in global_code if not line.startswith(('def', 'class')))
-    result['global'] = global_code_str
-    logger.debug("Global code extracted.")
-    
+        lines = [line.strip() for line in file_content.splitlines()]
+        result['library'] = '\n'.join(line for line in lines if line.startswith(('import', 'from')))
+        result['global'] = '\n'.join(line for line in lines if not line.startswith(('import', 'from', 'def', 'class')))
+        return result
+
+    extractor = EntityExtractor(file_content)
+    extractor.visit(tree)
+
+    result['library'] = '\n'.join(extractor.imports)
+    result['functions'] = extractor.functions
+    result['classes'] = extractor.classes
+    result['global'] = '\n'.join(extractor.global_code)
+    logger.debug(f"Extracted {len(extractor.functions)} functions and {len(extractor.classes)} classes.")
+
     return result
 
-def extract_entity_for_all_repo(py_files_content: dict) -> dict:
+def extract_file_entities(item: Tuple[str, str]) -> Tuple[dict, Optional[str]]:
+    """
+    Runs `extract_lib_func_class_global` on one file, catching any error so that a bad file does not stop a batch.
+
+    Args:
+        item (Tuple[str, str]): The file name and its content.
+
+    Returns:
+        Tuple[dict, Optional[str]]: The extracted record (None on failure) and the error message (None on success).
+    """
+    file_name, content = item
+    try:
+        return extract_lib_func_class_global(content), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def iter_extracted_entities(py_files_content, cache: Optional[DiskCache] = None, workers: int = 1,
+                            chunk_size: int = 64) -> Iterator[Tuple[Optional[str], str, dict]]:
+    """
+    Lazily extracts the entities of every file, optionally on a pool of worker processes.
+
+    Files are read in windows of `workers * chunk_size * 2` items: cache hits are resolved in the main
+    process, misses are sent to the pool in chunks of `chunk_size`, and the records of each window are
+    yielded in input order, so the output does not depend on the number of workers. A file whose
+    extraction raises is logged and skipped.
+
+    Args:
+        py_files_content (dict | Iterable): Dictionary with file names as keys and contents as values,
+            or an iterable of (repository, file name, content) tuples.
+        cache (DiskCache, optional): Persistent cache of extracted records.
+        workers (int): Number of worker processes; 1 runs serially in the current process, 0 uses every core.
+        chunk_size (int): Number of files sent to a worker at once.
+
+    Yields:
+        Tuple[Optional[str], str, dict]: The repository (None for dictionary input), the file name and its record.
+    """
+    if isinstance(py_files_content, dict):
+        files = ((None, file_name, content) for file_name, content in py_files_content.items())
+    else:
+        files = iter(py_files_content)
+
+    workers = workers or os.cpu_count()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    window_size = max(1, workers * chunk_size * 2)
+
+    try:
+        while True:
+            window = list(islice(files, window_size))
+            if not window:
+                break
+
+            records = [None] * len(window)
+            keys = [None] * len(window)
+            misses = []
+            for index, (_, file_name, content) in enumerate(window):
+                logger.info(f"Processing file: {file_name}")
+                if cache is not None:
+                    keys[index] = hash_key(EXTRACTOR_VERSION, content)
+                    records[index] = cache.get(keys[index])
+                if records[index] is None:
+                    misses.append(index)
+
+            items = [(window[index][1], window[index][2]) for index in misses]
+            if executor is None:
+                results = map(extract_file_entities, items)
+            else:
+                results = executor.map(extract_file_entities, items, chunksize=max(1, chunk_size))
+
+            for index, (record, error) in zip(misses, results):
+                if error is not None:
+                    logger.error(f"Error extracting entities from {window[index][1]}: {error}")
+                    continue
+                records[index] = record
+                if cache is not None:
+                    cache.set(keys[index], record)
+
+            for (repository, file_name, _), record in zip(window, records):
+                if record is not None:
+                    yield repository, file_name, record
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+def extract_entity_for_all_repo(py_files_content: dict, cache: Optional[DiskCache] = None,
+                                workers: int = 1, chunk_size: int = 64) -> dict:
     """
     Preprocesses all Python files to extract libraries, functions (with code), classes (with init and methods), and global code.
 
     Args:
-        py_files_content (dict): Dictionary with file names as keys and the content of the Python files as values.
+        py_files_content (dict): Dictionary with file names as keys and the content of the Python files as values,
+            or an iterable of (repository, file name, content) tuples such as the one yielded by
+            `iter_repositories_files`, which is consumed lazily.
+        cache (DiskCache, optional): Persistent cache of extracted records, keyed by the file content and
+            `EXTRACTOR_VERSION`. Files found in the cache are not parsed again.
+        workers (int): Number of worker processes; 1 runs serially, 0 uses every core.
+        chunk_size (int): Number of files sent to a worker at once.
 
     Returns:
         dict: A dictionary with preprocessed information for each file.
     """
-    processed_data = {}
     logger.info("Starting to process all Python files.")
 
-    for file_name, content in py_files_content.items():
-        logger.info(f"Processing file: {file_name}")
-        processed_data[file_name] = extract_lib_func_class_global(content)
-    
+    processed_data = {file_name: record for _, file_name, record
+                      in iter_extracted_entities(py_files_content, cache, workers, chunk_size)}
+
+    if cache is not None:
+        logger.info(f"Parse cache stats: {cache.stats()}")
     logger.info("All files processed.")
     return processed_data
 
@@ -211,7 +305,7 @@ def extract_subfolders(path: str, num_folders: int) -> str:
     # Extract the first `num_folders` subfolders
     extracted_folders = os.sep.join(parts[:num_folders])
     
-    logger.info(f"Extracted subfolders: {extracted_folders} from path: {path}")
+    logger.debug(f"Extracted subfolders: {extracted_folders} from path: {path}")
     
     return extracted_folders
 
@@ -242,10 +336,70 @@ def build_set_of_repositories(processed_files: dict, num_folders: int) -> set:
     
     return set_repository
 
+def split_path(path: str) -> Tuple[str, ...]:
+    """
+    Splits a path into its components, accepting both '/' and '\\' as separators.
+
+    Parameters:
+    -----------
+    path : str
+        The path to split.
+
+    Returns:
+    --------
+    Tuple[str, ...]
+        The non-empty components of the normalized path.
+    """
+    return tuple(part for part in re.split(r'[\\/]+', os.path.normpath(path)) if part and part != '.')
+
+def build_repository_index(set_repository: set) -> dict:
+    """
+    Builds a lookup table from the components of each repository root to the root itself.
+
+    Parameters:
+    -----------
+    set_repository : set
+        A set containing the repository roots.
+
+    Returns:
+    --------
+    dict
+        A dictionary with the split root as key and the original root as value.
+    """
+    return {split_path(repository): repository for repository in set_repository}
+
+def find_repository(path: str, repository_index: dict) -> Optional[str]:
+    """
+    Returns the deepest repository root that contains `path`, matching whole path components only.
+
+    Parameters:
+    -----------
+    path : str
+        The path of a file.
+    repository_index : dict
+        The lookup table returned by `build_repository_index`.
+
+    Returns:
+    --------
+    Optional[str]
+        The repository root, or None if no repository contains the file.
+    """
+    parts = split_path(path)
+    for depth in range(len(parts) - 1, 0, -1):
+        repository = repository_index.get(parts[:depth])
+        if repository is not None:
+            return repository
+    return None
+
 def merge_python_files_by_repository(processed_files: dict, set_repository: set) -> dict:
     """
     Merges the contents of Python files by repository based on the extracted subfolder paths.
 
+    Each file is assigned to its exact repository root in a single pass, so a repository whose name is
+    a prefix of another one (e.g. 'repo' and 'repo-v2') is not mixed up. Functions and classes are merged
+    in place; when the same name is defined in several files, the last definition is kept and every
+    defining file is listed under 'collisions'.
+
     Parameters:
     -----------
     processed_files : dict
@@ -256,29 +410,51 @@ def merge_python_files_by_repository(processed_files: dict, set_repository: set)
     Returns:
     --------
     dict
-        A dictionary containing merged files for each repository.
+        A dictionary containing merged files for each repository, with 'library', 'functions', 'classes',
+        'global' and 'collisions' ({'functions': {name: [files]}, 'classes': {name: [files]}}).
     """
+    repository_index = build_repository_index(set_repository)
     merged_python_files = {}
+    libraries, global_codes, sources = {}, {}, {}
 
-    for element_set in set_repository:
-        logger.info(f"Processing repository: {element_set}")
-        
-        merged_python_files[element_set] = {
+    for repository in set_repository:
+        merged_python_files[repository] = {
             'library': '',
             'functions': {},
             'classes': {},
-            'global': ''
+            'global': '',
+            'collisions': {'functions': {}, 'classes': {}}
         }
+        libraries[repository], global_codes[repository] = [], []
+        sources[repository] = {'functions': {}, 'classes': {}}
+
+    for key, file_info in processed_files.items():
+        repository = find_repository(key, repository_index)
+        if repository is None:
+            logger.warning(f"File {key} does not belong to any repository, skipping...")
+            continue
+        logger.debug(f"Merging data for repository: {repository} from file: {key}")
+
+        merged = merged_python_files[repository]
+        libraries[repository].append(file_info['library'])
+        global_codes[repository].append(file_info['global'])
+
+        for entity in ('functions', 'classes'):
+            entity_sources = sources[repository][entity]
+            for name in file_info[entity]:
+                if name in entity_sources:
+                    merged['collisions'][entity].setdefault(name, [entity_sources[name]]).append(key)
+                entity_sources[name] = key
+            merged[entity].update(file_info[entity])
+
+    for repository, merged in merged_python_files.items():
+        # Same layout as the previous incremental concatenation: every file is preceded by a newline
+        merged['library'] = ''.join('\n' + library for library in libraries[repository])
+        merged['global'] = ''.join('\n' + global_code for global_code in global_codes[repository])
+        logger.info(f"Repository {repository} merged with {len(merged['functions'])} functions, "
+                    f"{len(merged['classes'])} classes and "
+                    f"{len(merged['collisions']['functions']) + len(merged['collisions']['classes'])} name collisions.")
 
-        for key in processed_files.keys():
-            if element_set in key:
-                logger.debug(f"Merging data for repository: {element_set} from file: {key}")
-                
-                merged_python_files[element_set]['library'] += '\n' + processed_files[key]['library']
-                merged_python_files[element_set]['functions'] = {**merged_python_files[element_set]['functions'], **processed_files[key]['functions']}
-                merged_python_files[element_set]['classes'] = {**merged_python_files[element_set]['classes'], **processed_files[key]['classes']}
-                merged_python_files[element_set]['global'] += '\n' + processed_files[key]['global']
-    
     logger.info("Merging completed for all repositories.")
-    
+
     return merged_python_files
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Optional
+
+from src.utils.logger_utils import logger
+
+
+def hash_key(*parts: Any) -> str:
+    """
+    Builds a stable cache key from any number of JSON-serializable parts.
+
+    :param parts: The values identifying the cached item (e.g. a version and a file content).
+    :return: The hexadecimal SHA-256 digest of the parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True, default=str)
+        digest.update(part.encode('utf-8', 'surrogatepass'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Persistent key-value cache stored in a single SQLite file.
+
+    Values are stored as JSON. When the total size of the stored values exceeds `max_size_bytes`,
+    the least recently used entries are evicted. Hits and misses are counted for reporting.
+
+    The file is opened in write-ahead-log mode, so readers never wait for a writer and several processes can
+    share it; a process waits up to `timeout` seconds for another one to finish its write transaction.
+    """
+
+    # Number of write operations buffered before a commit
+    COMMIT_EVERY = 1000
+
+    def __init__(self, path: str, max_size_bytes: int = 512 * 1024 * 1024, timeout: float = 30.0):
+        """
+        Opens (or creates) the cache file.
+
+        :param path: Path of the SQLite file.
+        :param max_size_bytes: Maximum total size of the stored values; None disables eviction.
+        :param timeout: Seconds to wait for the write lock held by another process.
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending_writes = 0
+
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache(last_access)")
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        logger.debug(f"Cache '{path}' opened with {len(self)} entries ({self.total_size} bytes).")
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the value stored for `key`, or None on a miss.
+
+        :param key: The cache key.
+        :return: The cached value or None.
+        """
+        row = self.connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._maybe_commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Stores `value` for `key` and evicts old entries if the cache is over its size limit.
+
+        :param key: The cache key.
+        :param value: A JSON-serializable value.
+        """
+        payload = json.dumps(value)
+        size = len(payload)
+
+        previous = self.connection.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+        if previous is not None:
+            self.total_size -= previous[0]
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+            (key, payload, size, time.time())
+        )
+        self.total_size += size
+
+        if self.max_size_bytes is not None and self.total_size > self.max_size_bytes:
+            self._evict()
+        self._maybe_commit()
+
+    def _evict(self) -> None:
+        """Removes least recently used entries until the cache is back to 90% of its size limit."""
+        target = int(self.max_size_bytes * 0.9)
+        rows = self.connection.execute("SELECT key, size FROM cache ORDER BY last_access")
+        to_delete = []
+        for key, size in rows:
+            if self.total_size <= target:
+                break
+            to_delete.append((key,))
+            self.total_size -= size
+
+        self.connection.executemany("DELETE FROM cache WHERE key = ?", to_delete)
+        self.evictions += len(to_delete)
+        logger.debug(f"Evicted {len(to_delete)} entries from cache '{self.path}'.")
+
+    def _maybe_commit(self) -> None:
+        self._pending_writes += 1
+        if self._pending_writes >= self.COMMIT_EVERY:
+            self.commit()
+
+    def commit(self) -> None:
+        """Commits the pending writes, releasing the write lock for other processes sharing the file."""
+        self.connection.commit()
+        self._pending_writes = 0
+
+    def rollback(self) -> None:
+        """Discards the pending writes, e.g. after a write failed because the file stayed locked."""
+        self.connection.rollback()
+        self._pending_writes = 0
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters of the current session.
+
+        :return: A dictionary with hits, misses, hit_rate, evictions, entries and size in bytes.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self),
+            'size_bytes': self.total_size,
+        }
+
+    def close(self) -> None:
+        """Commits pending writes and closes the cache file."""
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
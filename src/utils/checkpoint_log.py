@@ -0,0 +1,112 @@
+import json
+import os
+from typing import Iterable, Optional
+
+from src.utils.logger_utils import logger
+
+
+class CheckpointLog:
+    """
+    Append-only JSON Lines log of per-row results, keyed by sample id.
+
+    Every record is written as one line as soon as its row completes and the file is flushed and synced after
+    each batch of records, so a crash loses at most the batch in progress. Only the byte offset of the last
+    record of each id is kept in memory; records are read back from the file when needed.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        """
+        Opens (or creates) the log.
+
+        :param path: Path of the JSON Lines file.
+        :param resume: If True, the records of an existing log are kept; otherwise the log is emptied.
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+        self.offsets = {}
+        self.failed = set()
+        if resume and os.path.exists(path):
+            self._load()
+        else:
+            open(path, 'wb').close()
+
+        self.writer = open(path, 'ab')
+        self.reader = open(path, 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load(self) -> None:
+        valid_end = 0
+        with open(self.path, 'rb') as f:
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._index(record, valid_end)
+                valid_end += len(line)
+
+        # A line cut by a crash is dropped, so the next record starts on a new line
+        if valid_end < os.path.getsize(self.path):
+            logger.warning(f"Dropping an incomplete record at the end of {self.path}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_end)
+        logger.info(f"Resuming from {self.path}: {len(self.offsets) - len(self.failed)} rows completed, "
+                    f"{len(self.failed)} failed.")
+
+    def _index(self, record: dict, offset: int) -> None:
+        self.offsets[record['Id']] = offset
+        if record.get('Error') is None:
+            self.failed.discard(record['Id'])
+        else:
+            self.failed.add(record['Id'])
+
+    def is_completed(self, sample_id: int) -> bool:
+        """
+        :param sample_id: The id of the row.
+        :return: True if the row has a record without error.
+        """
+        return sample_id in self.offsets and sample_id not in self.failed
+
+    def append(self, records: Iterable[dict]) -> None:
+        """
+        Appends records and makes them durable.
+
+        :param records: Dictionaries with an 'Id' and an 'Error' (None if the row succeeded).
+        """
+        self.writer.seek(0, os.SEEK_END)
+        for record in records:
+            offset = self.writer.tell()
+            self.writer.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+            self._index(record, offset)
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+
+    def read(self, sample_id: int) -> Optional[dict]:
+        """
+        Returns the last record of a row.
+
+        :param sample_id: The id of the row.
+        :return: The record, or None if the row has no record.
+        """
+        offset = self.offsets.get(sample_id)
+        if offset is None:
+            return None
+        self.reader.seek(offset)
+        return json.loads(self.reader.readline())
+
+    def close(self) -> None:
+        """Closes the log file."""
+        if self.writer is not None:
+            self.writer.close()
+            self.reader.close()
+            self.writer = None
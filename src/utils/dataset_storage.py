@@ -0,0 +1,297 @@
+import glob
+import hashlib
+import os
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.utils.logger_utils import logger
+
+# Schema of the samples produced by create_dataset; long prefixes need 64-bit string offsets
+DATASET_SCHEMA = pa.schema([
+    ('Prefix', pa.large_string()),
+    ('Suffix', pa.large_string()),
+    ('Label', pa.large_string()),
+    ('Context', pa.large_string()),
+])
+
+SHARD_PATTERN = '{}-{:05d}.parquet'
+
+
+class ShardedDatasetWriter:
+    """
+    Writes rows to a folder of compressed Parquet shards.
+
+    Rows are buffered and written in row groups of `row_group_size` rows; a new shard file is started
+    every `rows_per_shard` rows, so readers can process or distribute the shards independently.
+    """
+
+    def __init__(self, folder: str, schema: Optional[pa.Schema] = None, rows_per_shard: int = 100_000,
+                 row_group_size: int = 10_000, compression: str = 'zstd', name: str = 'part'):
+        """
+        :param folder: The folder receiving the shards; existing shards with the same name are removed.
+        :param schema: The Arrow schema of the rows; None infers it from the first row group.
+        :param rows_per_shard: Maximum number of rows of a shard file.
+        :param row_group_size: Number of rows of a row group.
+        :param compression: Parquet compression codec ('zstd', 'snappy', 'gzip', 'none').
+        :param name: Prefix of the shard files, so several writers (e.g. one per process) can share a folder.
+        """
+        os.makedirs(folder, exist_ok=True)
+        for shard in glob.glob(os.path.join(folder, f"{name}-{'[0-9]' * 5}.parquet")):
+            os.remove(shard)
+
+        self.folder = folder
+        self.name = name
+        self.schema = schema
+        self.rows_per_shard = rows_per_shard
+        self.row_group_size = min(row_group_size, rows_per_shard)
+        self.compression = compression
+        self.buffer = []
+        self.writer = None
+        self.shard_index = -1
+        self.rows_in_shard = 0
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, row: Dict) -> None:
+        """
+        Adds a row to the dataset.
+
+        :param row: A dictionary with one value per column.
+        """
+        self.buffer.append(row)
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+
+    def write_rows(self, rows: Iterable[Dict]) -> None:
+        """
+        Adds several rows to the dataset.
+
+        :param rows: An iterable of dictionaries with one value per column.
+        """
+        for row in rows:
+            self.write(row)
+
+    def flush(self) -> None:
+        """Writes the buffered rows, starting new shards as needed."""
+        while self.buffer:
+            if self.writer is None or self.rows_in_shard >= self.rows_per_shard:
+                self._open_next_shard()
+
+            count = min(len(self.buffer), self.rows_per_shard - self.rows_in_shard)
+            rows, self.buffer = self.buffer[:count], self.buffer[count:]
+            table = pa.Table.from_pylist(rows, schema=self.schema)
+            if self.schema is None:
+                self.schema = table.schema
+                self._open_writer()
+            self.writer.write_table(table)
+            self.rows_in_shard += count
+            self.rows_written += count
+
+    def _open_next_shard(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        self.shard_index += 1
+        self.rows_in_shard = 0
+        if self.schema is not None:
+            self._open_writer()
+
+    def _open_writer(self) -> None:
+        if self.writer is None:
+            path = os.path.join(self.folder, SHARD_PATTERN.format(self.name, self.shard_index))
+            self.writer = pq.ParquetWriter(path, self.schema, compression=self.compression)
+            logger.debug(f"Opened dataset shard {path}")
+
+    def close(self) -> None:
+        """Writes the remaining rows and closes the current shard."""
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        logger.info(f"Wrote {self.rows_written} rows in {self.shard_index + 1} shards to {self.folder}")
+
+
+def write_dataset(rows: Iterable[Dict], folder: str, schema: Optional[pa.Schema] = None,
+                  rows_per_shard: int = 100_000, row_group_size: int = 10_000, compression: str = 'zstd') -> int:
+    """
+    Writes an iterable of rows to a folder of Parquet shards, holding at most one row group in memory.
+
+    :param rows: An iterable of dictionaries with one value per column (e.g. a SampleSet).
+    :param folder: The folder receiving the shards.
+    :param schema: The Arrow schema of the rows; None infers it from the first row group.
+    :param rows_per_shard: Maximum number of rows of a shard file.
+    :param row_group_size: Number of rows of a row group.
+    :param compression: Parquet compression codec.
+    :return: The number of rows written.
+    """
+    with ShardedDatasetWriter(folder, schema, rows_per_shard, row_group_size, compression) as writer:
+        writer.write_rows(rows)
+    return writer.rows_written
+
+
+def list_shards(path: str) -> List[str]:
+    """
+    Returns the Parquet files of a dataset, in order.
+
+    :param path: A Parquet file or a folder of shards.
+    :return: The sorted list of Parquet files.
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*.parquet')))
+    return [path]
+
+
+def excel_to_parquet(path: str, folder: str = os.path.join('data', 'cache', 'datasets')) -> str:
+    """
+    Converts an Excel dataset (e.g. a manually filtered one) to Parquet, once per workbook content.
+
+    Parsing a workbook reads and decodes all of it, whatever the requested columns or rows, so a run converts
+    it once and reads, counts and slices the memory-mapped Parquet copy instead. The copy is named after the
+    hash of the workbook, so an edited workbook is converted again, and it is written under a temporary name
+    and renamed, so processes converting the same workbook concurrently never read a partial file.
+
+    :param path: A Parquet file, a folder of shards or an Excel file.
+    :param folder: The folder of the converted copies.
+    :return: The path of the Parquet copy, or `path` itself if it is not an Excel file.
+    """
+    if not path.endswith('.xlsx'):
+        return path
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    converted = os.path.join(folder, f"{os.path.splitext(os.path.basename(path))[0]}-{digest.hexdigest()[:16]}.parquet")
+    if os.path.exists(converted):
+        return converted
+
+    logger.info(f"Converting {path} to Parquet ({converted})...")
+    df = pd.read_excel(path)
+    # Excel cells of one column may mix text and numbers; such columns are stored as text
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].map(lambda value: None if pd.isna(value) else str(value))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # Columns without any value are typed as strings
+    table = table.cast(pa.schema([pa.field(field.name, pa.large_string()) if pa.types.is_null(field.type)
+                                  else field for field in table.schema]))
+
+    os.makedirs(folder, exist_ok=True)
+    temporary = f"{converted}.tmp{os.getpid()}"
+    pq.write_table(table, temporary, row_group_size=10_000, compression='zstd')
+    os.replace(temporary, converted)
+    return converted
+
+
+def read_dataset(path: str, columns: Optional[List[str]] = None, memory_map: bool = True) -> pd.DataFrame:
+    """
+    Reads a dataset into a DataFrame, loading only the requested columns.
+
+    Parquet files and shard folders are memory-mapped; `.xlsx` files (e.g. manually filtered datasets)
+    are read with pandas.
+
+    :param path: A Parquet file, a folder of shards or an Excel file.
+    :param columns: The columns to load; None loads every column.
+    :param memory_map: If True, Parquet files are memory-mapped instead of read into buffers.
+    :return: The dataset.
+    """
+    if path.endswith('.xlsx'):
+        return pd.read_excel(path, usecols=columns)
+
+    shards = list_shards(path)
+    if not shards:
+        raise FileNotFoundError(f"No Parquet shards found in {path}")
+    tables = [pq.read_table(shard, columns=columns, memory_map=memory_map) for shard in shards]
+    return pa.concat_tables(tables).to_pandas()
+
+
+def read_schema(path: str) -> pa.Schema:
+    """
+    Returns the Arrow schema of a dataset without reading its rows.
+
+    :param path: A Parquet file, a folder of shards or an Excel file.
+    :return: The schema; columns of an Excel file without values are typed as strings.
+    """
+    if path.endswith('.xlsx'):
+        schema = pa.Schema.from_pandas(pd.read_excel(path), preserve_index=False)
+        return pa.schema([pa.field(field.name, pa.large_string()) if pa.types.is_null(field.type) else field
+                          for field in schema])
+    return pq.read_schema(list_shards(path)[0]).remove_metadata()
+
+
+def count_rows(path: str) -> int:
+    """
+    Counts the rows of a dataset; for Parquet only the file footers are read.
+
+    :param path: A Parquet file, a folder of shards or an Excel file.
+    :return: The number of rows.
+    """
+    if path.endswith('.xlsx'):
+        return len(pd.read_excel(path, usecols=[0]))
+    return sum(pq.ParquetFile(shard).metadata.num_rows for shard in list_shards(path))
+
+
+def iter_dataset_batches(path: str, columns: Optional[List[str]] = None, batch_size: int = 10_000,
+                         start: int = 0, stop: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    """
+    Lazily reads a dataset in batches of rows, shard after shard.
+
+    Only the row groups overlapping the requested range are read, so a range at the end of a large dataset
+    is reached without decoding the rows before it. The index of each batch holds the position of its rows
+    in the whole dataset.
+
+    :param path: A Parquet file, a folder of shards or an Excel file.
+    :param columns: The columns to load; None loads every column.
+    :param batch_size: Maximum number of rows of a batch.
+    :param start: Position of the first row to read.
+    :param stop: Position after the last row to read; None reads until the end.
+    :return: An iterator of DataFrames.
+    """
+    if path.endswith('.xlsx'):
+        df = pd.read_excel(path, usecols=columns).iloc[start:stop]
+        for offset in range(0, len(df), batch_size):
+            yield df.iloc[offset:offset + batch_size]
+        return
+
+    position = 0
+    for shard in list_shards(path):
+        parquet_file = pq.ParquetFile(shard, memory_map=True)
+        for row_group in range(parquet_file.num_row_groups):
+            group_rows = parquet_file.metadata.row_group(row_group).num_rows
+            group_start, position = position, position + group_rows
+            if position <= start:
+                continue
+            if stop is not None and group_start >= stop:
+                return
+
+            df = parquet_file.read_row_group(row_group, columns=columns).to_pandas()
+            df.index = pd.RangeIndex(group_start, position)
+            df = df.loc[max(start, group_start):(position if stop is None else min(stop, position)) - 1]
+            for offset in range(0, len(df), batch_size):
+                yield df.iloc[offset:offset + batch_size]
+
+
+def export_excel_summary(df: pd.DataFrame, path: str, max_rows: Optional[int] = None) -> None:
+    """
+    Exports a small table (e.g. aggregated metrics or a sample for manual review) to Excel.
+
+    Excel is limited to about 1M rows and 32,767 characters per cell, so it should only be used for summaries.
+
+    :param df: The table to export.
+    :param path: The path of the `.xlsx` file.
+    :param max_rows: Maximum number of rows exported; None exports every row.
+    """
+    if max_rows is not None and len(df) > max_rows:
+        logger.warning(f"Exporting only the first {max_rows} of {len(df)} rows to {path}")
+        df = df.head(max_rows)
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    df.to_excel(path, index=False)
@@ -0,0 +1,219 @@
+import json
+import os
+import shutil
+import struct
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.utils.cache_utils import hash_key
+from src.utils.dataset_storage import iter_dataset_batches, list_shards
+from src.utils.logger_utils import logger
+
+# Bump when the layout of the cached arrays changes
+TOKEN_CACHE_VERSION = '1'
+
+
+def parquet_footer(path: str) -> bytes:
+    """
+    Reads the serialized footer of a Parquet file: its schema, row groups, column chunk offsets and sizes, and
+    column statistics.
+
+    :param path: The Parquet file.
+    :return: The raw footer bytes.
+    """
+    with open(path, 'rb') as f:
+        # A Parquet file ends with the footer, its length as a little-endian int32 and the magic 'PAR1'
+        f.seek(-8, os.SEEK_END)
+        length = struct.unpack('<i', f.read(4))[0]
+        f.seek(-8 - length, os.SEEK_END)
+        return f.read(length)
+
+
+def dataset_fingerprint(path: str) -> str:
+    """
+    Fingerprints a dataset from cheap file metadata, so a cache built for it is invalidated when any shard
+    changes without reading the data: the name, size and modification time of every shard, and the footer of
+    every Parquet file. Excel datasets are converted by `excel_to_parquet` to a file named after their content.
+
+    :param path: A Parquet file, a folder of shards or an Excel file.
+    :return: The hexadecimal SHA-256 digest of the metadata of the files.
+    """
+    files = []
+    for shard in list_shards(path):
+        stat = os.stat(shard)
+        footer = parquet_footer(shard).hex() if shard.endswith('.parquet') else None
+        files.append([os.path.basename(shard), stat.st_size, stat.st_mtime_ns, footer])
+    return hash_key(files)
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Fingerprints a tokenizer by its vocabulary and rules rather than by the model it ships with,
+    so models sharing a tokenizer share the cache.
+
+    :param tokenizer: A Hugging Face tokenizer.
+    :return: The hexadecimal SHA-256 digest identifying the tokenizer.
+    """
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        return hash_key(type(tokenizer).__name__, backend.to_str())
+    return hash_key(type(tokenizer).__name__, tokenizer.name_or_path, sorted(tokenizer.get_vocab().items()))
+
+
+class TokenizedColumn:
+    """
+    Read-only view of one pre-tokenized text column.
+
+    The token ids of every row are stored back to back in a flat memory-mapped array and `row_offsets[i]`
+    points to the first token of row i, so rows are sliced without copying and the pages are shared by every
+    process reading the same cache. `spans` holds the character span of each token in its row, when the
+    tokenizer provides them.
+    """
+
+    def __init__(self, folder: str, column: str):
+        """
+        :param folder: The folder of the cache entry.
+        :param column: The name of the column.
+        """
+        self.row_offsets = np.load(os.path.join(folder, f'{column}.offsets.npy'), mmap_mode='r')
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        dtype = meta['dtype']
+        # Position in the dataset of the first row of the entry
+        self.start = meta.get('start', 0)
+        self.ids = np.memmap(os.path.join(folder, f'{column}.ids.bin'), dtype=dtype, mode='r') \
+            if self.row_offsets[-1] else np.zeros(0, dtype=dtype)
+        spans_path = os.path.join(folder, f'{column}.spans.bin')
+        self.spans = None
+        if os.path.exists(spans_path):
+            self.spans = np.memmap(spans_path, dtype=np.int32, mode='r').reshape(-1, 2) \
+                if self.row_offsets[-1] else np.zeros((0, 2), dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.row_offsets) - 1
+
+    def encoding(self, row: int) -> Tuple[List[int], Optional[List[Tuple[int, int]]]]:
+        """
+        Returns the tokens of a row in the format used by FIMPromptBuilder.
+
+        :param row: The position of the row in the dataset.
+        :return: The token ids and the character spans of the tokens (None if not stored).
+        """
+        start, end = self.row_offsets[row - self.start], self.row_offsets[row - self.start + 1]
+        spans = self.spans[start:end].tolist() if self.spans is not None else None
+        return self.ids[start:end].tolist(), spans
+
+
+class TokenCache:
+    """
+    On-disk cache of pre-tokenized datasets.
+
+    Each entry is keyed by the tokenizer fingerprint, the dataset fingerprint and the range of rows it covers,
+    so every shard of an evaluation tokenizes only its own rows, and stored in its own folder:
+    a flat `<column>.ids.bin` array of token ids, a `<column>.spans.bin` array of character spans and a
+    `<column>.offsets.npy` index of the first token of each row. Entries are built once and then only
+    memory-mapped, so later runs start without tokenizing anything.
+    """
+
+    def __init__(self, folder: str):
+        """
+        :param folder: The folder holding the cache entries.
+        """
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def entry_folder(self, dataset_path: str, tokenizer, columns: Sequence[str], start: int = 0,
+                     stop: Optional[int] = None) -> str:
+        """
+        Returns the folder of the cache entry of a dataset and a tokenizer.
+
+        :param dataset_path: A Parquet file, a folder of shards or an Excel file.
+        :param tokenizer: A Hugging Face tokenizer.
+        :param columns: The tokenized columns.
+        :param start: Position of the first row of the entry.
+        :param stop: Position after the last row of the entry; None covers the rows up to the end.
+        :return: The path of the entry folder (which may not exist yet).
+        """
+        key = hash_key(TOKEN_CACHE_VERSION, tokenizer_fingerprint(tokenizer), dataset_fingerprint(dataset_path),
+                       list(columns), start, stop)
+        return os.path.join(self.folder, key)
+
+    def load_or_build(self, dataset_path: str, tokenizer, columns: Sequence[str] = ('Prefix', 'Suffix'),
+                      batch_size: int = 1000, start: int = 0, stop: Optional[int] = None) -> dict:
+        """
+        Returns the pre-tokenized columns of the rows [start, stop) of a dataset, tokenizing them only if no entry
+        exists. Rows are still addressed by their position in the dataset.
+
+        :param dataset_path: A Parquet file, a folder of shards or an Excel file.
+        :param tokenizer: A Hugging Face tokenizer.
+        :param columns: The columns to tokenize.
+        :param batch_size: Number of rows tokenized at once when building the entry.
+        :param start: Position of the first row.
+        :param stop: Position after the last row; None covers the rows up to the end.
+        :return: A dictionary mapping each column to its TokenizedColumn.
+        """
+        folder = self.entry_folder(dataset_path, tokenizer, columns, start, stop)
+        if os.path.exists(os.path.join(folder, 'meta.json')):
+            logger.info(f"Loaded pre-tokenized dataset from {folder}")
+        else:
+            self.build(folder, dataset_path, tokenizer, columns, batch_size, start, stop)
+        return {column: TokenizedColumn(folder, column) for column in columns}
+
+    def build(self, folder: str, dataset_path: str, tokenizer, columns: Sequence[str], batch_size: int,
+              start: int = 0, stop: Optional[int] = None) -> None:
+        """
+        Tokenizes the columns of the rows [start, stop) of a dataset into a new cache entry.
+
+        The entry is written to a temporary folder and renamed at the end, so an interrupted build never
+        leaves a partial entry behind.
+
+        :param folder: The folder of the entry.
+        :param dataset_path: A Parquet file, a folder of shards or an Excel file.
+        :param tokenizer: A Hugging Face tokenizer.
+        :param columns: The columns to tokenize.
+        :param batch_size: Number of rows tokenized at once.
+        :param start: Position of the first row.
+        :param stop: Position after the last row; None covers the rows up to the end.
+        """
+        temporary_folder = f'{folder}.tmp{os.getpid()}'
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        os.makedirs(temporary_folder)
+
+        # uint16 halves the size of the arrays for vocabularies below 65,536 tokens
+        dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max else np.int32
+        with_spans = getattr(tokenizer, 'is_fast', False)
+        ids_files = {column: open(os.path.join(temporary_folder, f'{column}.ids.bin'), 'wb') for column in columns}
+        spans_files = {column: open(os.path.join(temporary_folder, f'{column}.spans.bin'), 'wb')
+                       for column in columns} if with_spans else {}
+        row_offsets = {column: [0] for column in columns}
+        rows = 0
+        try:
+            for batch in iter_dataset_batches(dataset_path, columns=list(columns), batch_size=batch_size,
+                                              start=start, stop=stop):
+                rows += len(batch)
+                for column in columns:
+                    texts = batch[column].fillna('').astype(str).tolist()
+                    encodings = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=with_spans)
+                    for index, ids in enumerate(encodings['input_ids']):
+                        ids_files[column].write(np.asarray(ids, dtype=dtype).tobytes())
+                        if with_spans:
+                            spans = np.asarray(encodings['offset_mapping'][index], dtype=np.int32).reshape(-1, 2)
+                            spans_files[column].write(spans.tobytes())
+                        row_offsets[column].append(row_offsets[column][-1] + len(ids))
+        finally:
+            for f in list(ids_files.values()) + list(spans_files.values()):
+                f.close()
+
+        for column in columns:
+            np.save(os.path.join(temporary_folder, f'{column}.offsets.npy'), np.asarray(row_offsets[column], np.int64))
+        with open(os.path.join(temporary_folder, 'meta.json'), 'w') as f:
+            json.dump({'version': TOKEN_CACHE_VERSION, 'dataset': dataset_path, 'tokenizer': tokenizer.name_or_path,
+                       'dtype': np.dtype(dtype).name, 'start': start, 'rows': rows, 'columns': list(columns),
+                       'tokens': {column: row_offsets[column][-1] for column in columns}}, f, indent=2)
+        try:
+            os.replace(temporary_folder, folder)
+        except OSError:
+            # Another process (e.g. another shard of the same evaluation) built the same entry first
+            shutil.rmtree(temporary_folder, ignore_errors=True)
+        logger.info(f"Pre-tokenized rows {start}-{start + rows} of {dataset_path} into {folder}")
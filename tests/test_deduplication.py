@@ -0,0 +1,48 @@
+from src.ETL.deduplication import NearDuplicateFilter, optimal_bands
+
+
+def tokens(prefix, count):
+    return [f"{prefix}{index}" for index in range(count)]
+
+
+def shared_bands(duplicate_filter, first, second):
+    signatures = [duplicate_filter.hasher.signature(text.split()) for text in (first, second)]
+    rows = duplicate_filter.rows
+    return sum(signatures[0][band * rows:(band + 1) * rows].tobytes()
+               == signatures[1][band * rows:(band + 1) * rows].tobytes() for band in range(duplicate_filter.bands))
+
+
+def test_near_duplicate_is_removed():
+    duplicate_filter = NearDuplicateFilter(threshold=0.8, shingle_size=1)
+    original = tokens('a', 100)
+    assert duplicate_filter.check('original', ' '.join(original)) is None
+    # Jaccard similarity 95 / 105 = 0.90
+    assert duplicate_filter.check('copy', ' '.join(original[:95] + tokens('b', 5))) == 'original'
+    assert duplicate_filter.removed['original'] == 1
+
+
+def test_pair_below_threshold_sharing_a_band_is_kept():
+    duplicate_filter = NearDuplicateFilter(threshold=0.8, shingle_size=1)
+    original = tokens('a', 100)
+    # Jaccard similarity 86 / 114 = 0.75: the pair shares an LSH band but is not a near-duplicate
+    similar = original[:86] + tokens('c', 14)
+    assert shared_bands(duplicate_filter, ' '.join(original), ' '.join(similar)) > 0
+
+    assert duplicate_filter.check('original', ' '.join(original)) is None
+    assert duplicate_filter.check('similar', ' '.join(similar)) is None
+    assert duplicate_filter.kept == 2
+    # The kept item is indexed, so its own copies are removed
+    assert duplicate_filter.check('copy', ' '.join(similar)) == 'similar'
+
+
+def test_unrelated_items_are_kept():
+    duplicate_filter = NearDuplicateFilter(threshold=0.8, shingle_size=1)
+    for index in range(20):
+        assert duplicate_filter.check(str(index), ' '.join(tokens(f'{index}_', 50))) is None
+    assert not duplicate_filter.removed
+
+
+def test_optimal_bands_fit_permutations():
+    bands, rows = optimal_bands(128, 0.8)
+    assert bands * rows <= 128
+    assert abs((1 / bands) ** (1 / rows) - 0.8) < 0.05
@@ -0,0 +1,86 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from src.ETL.extraction import clone_or_fetch_repository, clone_repositories
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+
+GIT_ENV = {**os.environ, 'GIT_AUTHOR_NAME': 'test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+           'GIT_COMMITTER_NAME': 'test', 'GIT_COMMITTER_EMAIL': 'test@example.com'}
+
+
+def git(*args):
+    return subprocess.run(['git', *args], check=True, capture_output=True, text=True, env=GIT_ENV).stdout.strip()
+
+
+def commit_file(work_tree, name, content):
+    with open(os.path.join(work_tree, name), 'w') as f:
+        f.write(content)
+    git('-C', work_tree, 'add', name)
+    git('-C', work_tree, 'commit', '--quiet', '-m', f'Add {name}')
+    git('-C', work_tree, 'push', '--quiet', 'origin', 'HEAD')
+
+
+@pytest.fixture
+def remotes(tmp_path):
+    """Creates bare repositories served through file:// URLs and a work tree pushing to each of them."""
+    def create(name):
+        bare = tmp_path / 'remotes' / f'{name}.git'
+        git('init', '--quiet', '--bare', str(bare))
+        # Needed by blobless clones
+        git('-C', str(bare), 'config', 'uploadpack.allowFilter', 'true')
+        work_tree = tmp_path / 'work' / name
+        git('clone', '--quiet', str(bare), str(work_tree))
+        commit_file(str(work_tree), 'main.py', f'def {name}():\n    return 1\n')
+        return f'file://{bare}', str(work_tree)
+    return create
+
+
+@pytest.mark.parametrize('mode', ['full', 'shallow', 'blobless'])
+def test_clone_then_fetch(remotes, tmp_path, mode):
+    url, work_tree = remotes('alpha')
+    target = str(tmp_path / 'repos')
+
+    assert clone_or_fetch_repository(url, target, mode)[:2] == ('alpha', 'cloned')
+    assert os.path.exists(os.path.join(target, 'alpha', 'main.py'))
+
+    commit_file(work_tree, 'second.py', 'x = 2\n')
+    assert clone_or_fetch_repository(url, target, mode)[:2] == ('alpha', 'fetched')
+    assert os.path.exists(os.path.join(target, 'alpha', 'second.py'))
+    assert git('-C', os.path.join(target, 'alpha'), 'rev-parse', 'HEAD') == git('-C', work_tree, 'rev-parse', 'HEAD')
+
+
+def test_existing_repository_is_skipped_without_fetch(remotes, tmp_path):
+    url, work_tree = remotes('alpha')
+    target = str(tmp_path / 'repos')
+    clone_or_fetch_repository(url, target)
+    commit_file(work_tree, 'second.py', 'x = 2\n')
+
+    assert clone_or_fetch_repository(url, target, fetch_existing=False)[:2] == ('alpha', 'skipped')
+    assert not os.path.exists(os.path.join(target, 'alpha', 'second.py'))
+
+
+def test_unknown_mode_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        clone_or_fetch_repository('file:///missing.git', str(tmp_path), mode='sparse')
+
+
+def test_clone_repositories_concurrently(remotes, tmp_path):
+    urls = [remotes(name)[0] for name in ('alpha', 'beta', 'gamma')]
+    missing = f"file://{tmp_path / 'remotes' / 'missing.git'}"
+    target = str(tmp_path / 'repos')
+    cwd = os.getcwd()
+
+    report = clone_repositories(urls + [missing], target, max_workers=3)
+    assert {name: action for name, (action, _) in report.items()} == {
+        'alpha': 'cloned', 'beta': 'cloned', 'gamma': 'cloned', 'missing': 'failed'}
+    for name in ('alpha', 'beta', 'gamma'):
+        assert os.path.exists(os.path.join(target, name, 'main.py'))
+    # Git commands run with explicit working directories
+    assert os.getcwd() == cwd
+
+    report = clone_repositories(urls, target, max_workers=3)
+    assert {action for action, _ in report.values()} == {'fetched'}
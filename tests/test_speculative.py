@@ -0,0 +1,66 @@
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+from src.AI_models.hugging_face_model import ModelHandler
+
+VOCABULARY = ['<|endoftext|>', 'def', 'return', 'if', 'else', 'for', 'in', 'x', 'y', 'z', '(', ')', ':', '=', '+',
+              '-', '*', '0', '1', '2', ',', '.', 'self', 'None', 'True', 'False', '\n', '    ']
+PROMPTS = ['def x ( y ) :', 'for x in y :', 'if x = = 0 :', 'return self . x + 1']
+GREEDY = {'max_new_tokens': 16, 'do_sample': False, 'num_beams': 1}
+
+
+def save_model(folder, tokenizer, num_layers, seed):
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=len(VOCABULARY), n_positions=64, n_embd=32, n_layer=num_layers, n_head=2,
+                        initializer_range=1.0, bos_token_id=0, eos_token_id=0)
+    GPT2LMHeadModel(config).save_pretrained(folder)
+    tokenizer.save_pretrained(folder)
+    return str(folder)
+
+
+@pytest.fixture(scope='module')
+def checkpoints(tmp_path_factory):
+    """Saves a tiny target model, a smaller draft model and a copy of the target, sharing one tokenizer."""
+    backend = Tokenizer(models.WordLevel({token: index for index, token in enumerate(VOCABULARY)},
+                                         unk_token='<|endoftext|>'))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    backend.decoder = decoders.WordPiece(prefix='##')
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, eos_token='<|endoftext|>')
+    folder = tmp_path_factory.mktemp('models')
+    return {'target': save_model(folder / 'target', tokenizer, num_layers=2, seed=0),
+            'draft': save_model(folder / 'draft', tokenizer, num_layers=1, seed=1),
+            'copy': save_model(folder / 'copy', tokenizer, num_layers=2, seed=0)}
+
+
+def generate(handler):
+    return [handler.generate(prompt) for prompt in PROMPTS]
+
+
+def test_greedy_outputs_match_decoding_without_draft(checkpoints):
+    reference = generate(ModelHandler(checkpoints['target'], GREEDY))
+    handler = ModelHandler(checkpoints['target'], GREEDY,
+                           speculative={'draft_checkpoint': checkpoints['draft'], 'baseline_every': 1})
+    assert generate(handler) == reference
+
+    stats = handler.speculative_decoder.stats()
+    assert stats['generations'] == len(PROMPTS)
+    assert stats['baseline_generations'] == len(PROMPTS)
+    assert stats['baseline_mismatches'] == 0
+    assert 0.0 <= stats['acceptance_rate'] <= 1.0
+
+
+def test_identical_draft_is_accepted(checkpoints):
+    handler = ModelHandler(checkpoints['target'], GREEDY, speculative={'draft_checkpoint': checkpoints['copy']})
+    generate(handler)
+
+    stats = handler.speculative_decoder.stats()
+    assert stats['acceptance_rate'] > 0.9
+    assert stats['tokens_per_target_pass'] > 1
+
+
+def test_beam_search_is_rejected(checkpoints):
+    with pytest.raises(ValueError):
+        ModelHandler(checkpoints['target'], {**GREEDY, 'num_beams': 2},
+                     speculative={'draft_checkpoint': checkpoints['draft']})
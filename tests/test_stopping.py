@@ -0,0 +1,114 @@
+import pytest
+import torch
+
+from src.AI_models.stopping import (CompletionStoppingCriteria, NewlineStop, StatementEndStop, build_stop_conditions,
+                                    ends_statement, newline_token_ids)
+
+
+class StubTokenizer:
+    """Tokenizer whose token ids index a fixed list of strings."""
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.ids = {token: token_id for token_id, token in enumerate(vocabulary)}
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def encode(self, tokens):
+        return [self.ids[token] for token in tokens]
+
+    def decode(self, token_ids):
+        return ''.join(self.vocabulary[token_id] for token_id in list(token_ids))
+
+    def batch_decode(self, sequences):
+        return [self.decode(token_ids) for token_ids in sequences]
+
+
+TOKENIZER = StubTokenizer(['<pad>', '<fim_prefix>', '<fim_suffix>', '<fim_middle>', 'x = ', 'f(', '1', ', ', ')',
+                           '\n', ')\n', 'y', ' + ', '"""', 'doc'])
+PROMPT_LENGTH = 6
+
+
+def prompt(*cursor_line):
+    return TOKENIZER.encode(['<fim_prefix>', *cursor_line, '<fim_suffix>', '<fim_middle>'])
+
+
+def rows(prompts, *completions):
+    """
+    Builds the rows seen by the criteria: every prompt left-padded to PROMPT_LENGTH, repeated once per completion
+    of the prompt, followed by the completion.
+    """
+    per_prompt = len(completions) // len(prompts)
+    return torch.tensor([[0] * (PROMPT_LENGTH - len(prompts[index // per_prompt])) + prompts[index // per_prompt]
+                         + TOKENIZER.encode(completion) for index, completion in enumerate(completions)])
+
+
+def criteria(conditions, prompts, token_budget=None):
+    return CompletionStoppingCriteria(TOKENIZER, conditions, newline_token_ids(TOKENIZER), prompts, PROMPT_LENGTH,
+                                      token_budget)
+
+
+@pytest.mark.parametrize('source, expected', [
+    ('x = 1\n', True),
+    ('x = f(1,\n', False),
+    ('x = """doc\n', False),
+    ('x = f(1)\n', True),
+    # A bracket opened on a previous line cannot be resolved from this one
+    ('1)\n', True),
+])
+def test_ends_statement(source, expected):
+    assert ends_statement(source) == expected
+
+
+def test_newline_stop():
+    assert NewlineStop().end('y + 1', None) is None
+    assert NewlineStop().end('y + 1\nz', None) == 5
+
+
+def test_statement_end_stop_completes_brackets():
+    condition = StatementEndStop()
+    context = condition.prepare('<fim_prefix>def g():\n    x = <fim_suffix>\nreturn x<fim_middle>')
+    assert context == 'x = '
+    assert condition.end('f(1,\n', context) is None
+    assert condition.end('f(1,\n  y)\nz', context) == 9
+
+
+def test_newline_criteria_stop_rows_independently():
+    prompts = [prompt('x = ')]
+    stopping = criteria([NewlineStop()], prompts)
+    done = stopping(rows(prompts, ['y', ' + '], ['y', '\n']), None)
+    assert done.tolist() == [False, True]
+    assert stopping.trim('y\n + 1', 0) == 'y'
+
+
+def test_statement_end_criteria():
+    prompts = [prompt('x = '), prompt('x = ', 'f(')]
+    stopping = criteria([StatementEndStop()], prompts)
+    # The first prompt ends its statement at the newline; the second one is still inside the call
+    done = stopping(rows(prompts, ['1', '\n'], ['1', '\n']), None)
+    assert done.tolist() == [True, False]
+    assert stopping(rows(prompts, ['1', '\n'], ['1', ')\n']), None).tolist() == [True, True]
+
+
+def test_rows_of_a_prompt_share_its_context():
+    prompts = [prompt('x = '), prompt('x = ', 'f(')]
+    stopping = criteria([StatementEndStop()], prompts)
+    # Two returned sequences per prompt
+    done = stopping(rows(prompts, ['y', '\n'], ['y', ' + '], ['y', '\n'], ['y', ')\n']), None)
+    assert done.tolist() == [True, False, False, True]
+
+
+def test_token_budget_stops_every_row():
+    prompts = [prompt('x = ')]
+    stopping = criteria([], prompts, token_budget=3)
+    assert stopping(rows(prompts, ['y', ' + ']), None).tolist() == [False]
+    assert stopping(rows(prompts, ['y', ' + ', '1']), None).tolist() == [True]
+    assert stopping.trim('y + 1\n', 0) == 'y + 1\n'
+
+
+def test_build_stop_conditions():
+    conditions = build_stop_conditions(['newline', 'statement_end'])
+    assert [type(condition) for condition in conditions] == [NewlineStop, StatementEndStop]
+    with pytest.raises(ValueError):
+        build_stop_conditions(['semicolon'])